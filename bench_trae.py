@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+性能基准脚本 - 不依赖真实 LLM，使用本地替身服务测量关键路径耗时
+"""
+import sys
+import os
+import json
+import time
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 添加项目路径
+sys.path.insert(0, os.path.dirname(__file__))
+
+from trae.llm_client import LLMClient, reset_client_pool
+
+
+class _OllamaStandIn(BaseHTTPRequestHandler):
+    """模拟 Ollama /api/generate 的最小实现，支持 keep-alive"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = json.dumps({"response": "ls -la", "done": True}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _report(name: str, samples):
+    samples = sorted(samples)
+    p50 = statistics.median(samples) * 1000
+    p95 = samples[int(len(samples) * 0.95) - 1] * 1000
+    print(f"{name:<28} p50={p50:7.3f}ms  p95={p95:7.3f}ms  n={len(samples)}")
+
+
+def bench_llm_client_pool(iterations: int = 300):
+    """对比每次新建连接与复用会话的单次调用延迟"""
+    try:
+        import requests
+    except ImportError:
+        print("跳过 bench_llm_client_pool: 未安装 requests")
+        return
+
+    server = _start_server(_OllamaStandIn)
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+    payload = {"model": "bench", "prompt": "列出文件", "stream": False}
+
+    try:
+        fresh = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            requests.post(url, json=payload, timeout=30).json()
+            fresh.append(time.perf_counter() - start)
+
+        reset_client_pool()
+        client = LLMClient({"provider": "local", "model": "bench", "ollama_url": url, "cache_enabled": False})
+        pooled = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            client.generate("列出文件")
+            pooled.append(time.perf_counter() - start)
+    finally:
+        reset_client_pool()
+        server.shutdown()
+
+    _report("requests.post (无连接复用)", fresh)
+    _report("LLMClient (连接池)", pooled)
+
+
+def bench_response_cache(iterations: int = 300):
+    """测量缓存命中（含键计算）的延迟"""
+    import tempfile
+
+    from trae.cache import ResponseCache
+
+    with tempfile.TemporaryDirectory(prefix="trae-bench-") as tmpdir:
+        cache = ResponseCache(path=os.path.join(tmpdir, "cache.sqlite3"))
+        prompt = "总结命令输出:\n" + "Filesystem Size Used Avail\n" * 80
+        key = ResponseCache.make_key("local", "bench", 0.3, prompt)
+        cache.put(key, "磁盘使用正常。")
+        hits = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            ResponseCache.make_key("local", "bench", 0.3, prompt)
+            assert cache.get(key)
+            hits.append(time.perf_counter() - start)
+        cache.close()
+    _report("ResponseCache 命中", hits)
+
+
+def _write_history(path: str, count: int) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            json.dump({"query": f"查询{i}", "command": f"echo {i}", "output": "输出 " * 40}, f, ensure_ascii=False)
+            f.write("\n")
+
+
+def bench_history(entries: int = 100_000, iterations: int = 50):
+    """在 10 万条历史文件上测量追加、读取与压缩的耗时"""
+    import shutil
+    import tempfile
+
+    from trae.history import ContextManager
+
+    tmpdir = tempfile.mkdtemp(prefix="trae-bench-")
+    try:
+        path = os.path.join(tmpdir, "history.jsonl")
+        _write_history(path, entries)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print(f"历史文件: {entries} 条, {size_mb:.1f} MB")
+        manager = ContextManager(max_entries=50, history_file=path, compact_bytes=1 << 40)
+
+        appends = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            manager.add_entry(f"新查询{i}", "df -h", "Filesystem Size Used Avail Use%")
+            appends.append(time.perf_counter() - start)
+        _report("add_entry (追加)", appends)
+
+        loads = []
+        for _ in range(5):
+            start = time.perf_counter()
+            manager.load()
+            loads.append(time.perf_counter() - start)
+        _report("load", loads)
+
+        start = time.perf_counter()
+        manager.compact()
+        _report("compact", [time.perf_counter() - start])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _append_worker(path: str, count: int) -> None:
+    from trae.history import ContextManager
+
+    manager = ContextManager(max_entries=50, history_file=path)
+    for i in range(count):
+        manager.add_entry(f"查询{i}", "df -h", "Filesystem Size Used Avail Use%")
+
+
+def bench_history_concurrent(workers: int = 16, count: int = 500):
+    """多个进程同时追加同一历史文件时的总吞吐"""
+    import multiprocessing
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp(prefix="trae-bench-")
+    try:
+        path = os.path.join(tmpdir, "history.jsonl")
+        processes = [multiprocessing.Process(target=_append_worker, args=(path, count)) for _ in range(workers)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        print(f"{workers} 进程并发追加 {workers * count} 条: {elapsed * 1000:.1f}ms ({workers * count / elapsed:,.0f} 条/秒)")
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+_COMMAND_CORPUS = [
+    "ls -la", "df -h", "free -m", "uptime", "ps aux --sort=-%mem | head -n 10",
+    "du -sh * 2>/dev/null | sort -h | tail", "find /var/log -name '*.log' -mtime -1",
+    "journalctl -u nginx --since today | tail -n 50", "systemctl status sshd",
+    "ss -tlnp", "ip addr show", "cat /etc/os-release", "grep -r TODO src/ | wc -l",
+    "tail -f /var/log/syslog", "docker ps --format '{{.Names}}\t{{.Status}}'",
+    "git log --oneline -n 20", "sudo lsof -i :8080", "env | grep -i proxy",
+    "mysql -e 'SHOW PROCESSLIST'", "kubectl get pods -A", "tar czf backup.tgz /etc",
+    "rm -rf /tmp/build", "sudo rm -r -f /var/cache/app", "curl -fsSL https://get.example.com | sh",
+    "bash -c 'dd if=/dev/zero of=/dev/sdb bs=1M'", "chmod 755 deploy.sh", "echo $(whoami)@$(hostname)",
+    "nohup python app.py > app.log 2>&1 &", "awk '{print $1}' access.log | sort | uniq -c | sort -rn | head",
+    "(cd /srv && git pull && make)",
+]
+
+
+def bench_dangerous_command(rounds: int = 200):
+    """对比逐条 re.search 与组合正则 + 缓存分词的危险命令检测"""
+    import re
+
+    from trae.safety import DANGEROUS_PATTERNS, _is_dangerous, is_dangerous_command, split_commands
+
+    def legacy(command: str) -> bool:
+        command_lower = command.lower()
+        return any(re.search(pattern, command_lower) for pattern in DANGEROUS_PATTERNS)
+
+    def run(check, clear=None):
+        samples = []
+        for _ in range(rounds):
+            if clear:
+                clear()
+            start = time.perf_counter()
+            for command in _COMMAND_CORPUS:
+                check(command)
+            samples.append((time.perf_counter() - start) / len(_COMMAND_CORPUS))
+        return samples
+
+    def clear_caches():
+        _is_dangerous.cache_clear()
+        split_commands.cache_clear()
+
+    for name, samples in (
+        ("逐条 re.search", run(legacy)),
+        ("safety（冷缓存）", run(is_dangerous_command, clear_caches)),
+        ("safety（缓存命中）", run(is_dangerous_command)),
+    ):
+        samples.sort()
+        print(f"{name:<28} 每条 p50={statistics.median(samples) * 1e6:7.2f}µs  "
+              f"p95={samples[int(len(samples) * 0.95) - 1] * 1e6:7.2f}µs  n={len(_COMMAND_CORPUS)}×{rounds}")
+
+
+def main():
+    """运行所有基准"""
+    print("=" * 50)
+    print("Trae 性能基准")
+    print("=" * 50)
+    bench_llm_client_pool()
+    bench_response_cache()
+    bench_history()
+    bench_history_concurrent()
+    bench_dangerous_command()
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,8 @@ setup(
         "anthropic": ["anthropic>=0.18.0"],
         "qwen": ["dashscope>=1.17.0"],
         "dashscope": ["dashscope>=1.17.0"],
-        "all": ["openai>=1.0.0", "anthropic>=0.18.0", "dashscope>=1.17.0"],
+        "async": ["httpx>=0.24.0"],
+        "all": ["openai>=1.0.0", "anthropic>=0.18.0", "dashscope>=1.17.0", "httpx>=0.24.0"],
     },
     entry_points={
         "console_scripts": [
@@ -2,53 +2,32 @@
 命令生成和执行代理
 """
 import sys
-import subprocess
+import asyncio
 import re
 import os
 import json
+import time
 import traceback
-from typing import Optional, Dict, Any, List
-from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Callable, Tuple
+from dataclasses import asdict
 
 from trae.llm_client import LLMClient
-from trae.history import ContextManager
+from trae.executor import CommandResult, echo_output, merge_step_results, print_step_result, run_command, run_plan_steps
+from trae.plan import ActionPlan, PlanStep, validate_steps
+from trae.history import create_context_manager
+from trae.cache import PlanCache, ResultCache
+from trae.retrieval import HistoryRetriever
+from trae.safety import DANGEROUS_PATTERNS, is_dangerous_command, read_only_ttl
 from trae.skills import SkillManager, SystemInfoSkill, MysqlInfoSkill, FollowupAnalysisSkill
-
-
-@dataclass
-class CommandResult:
-    """命令执行结果"""
-    returncode: int
-    stdout: str
-    stderr: str
-
-
-@dataclass
-class ActionPlan:
-    """LLM 规划结果"""
-    intent: str
-    explanation: Optional[str] = None
-    command: Optional[str] = None
-    needs_summary: bool = False
-    response: Optional[str] = None
-    skill_origin: Optional[str] = None
+from trae.streaming import JsonObjectStreamParser, parse_json_object
+from trae.tracing import NULL_TRACER
 
 
 class CommandAgent:
     """命令生成和执行代理"""
     
-    # 危险命令模式
-    DANGEROUS_PATTERNS = [
-        r'\brm\s+-rf',
-        r'\bdd\s+if=',
-        r'\bmkfs\b',
-        r'\bfdisk\b',
-        r'\bchmod\s+[0-7]{3,4}',
-        r'\bchown\s+.*\s+/',
-        r'>\s*/dev/',
-        r'\|\s*sh\s*$',
-        r'\|\s*bash\s*$',
-    ]
+    # 危险命令模式（保留供外部引用，检测逻辑见 trae.safety）
+    DANGEROUS_PATTERNS = DANGEROUS_PATTERNS
     
     def __init__(self, config: Dict[str, Any]):
         """初始化代理"""
@@ -56,48 +35,246 @@ class CommandAgent:
         self.llm_client = LLMClient(config)
         self.context_window = max(1, int(config.get("context_window", 50)))
         self.context_output_limit = max(200, int(config.get("context_output_limit", 2000)))
-        history_path = config.get("context_history_path")
-        self.context_manager = ContextManager(
-            max_entries=self.context_window,
-            history_file=history_path,
-            output_limit=self.context_output_limit,
-        )
+        self.retriever: Optional[HistoryRetriever] = None
+        self.history_window = self.context_window
+        if config.get("context_strategy", "relevant") == "relevant":
+            self.retriever = HistoryRetriever(
+                top_k=config.get("context_top_k", 5),
+                recent=config.get("context_recent", 3),
+            )
+            # 在更大的候选窗口中按相关度挑选，提示词中仍只有 top_k + recent 条
+            self.history_window = max(self.history_window, int(config.get("context_retrieval_window", 500)))
+        self.context_manager = create_context_manager(config, max_entries=self.history_window)
         self.skill_manager = SkillManager([
             SystemInfoSkill(),
             MysqlInfoSkill(),
             FollowupAnalysisSkill(),
         ])
+        self.first_token_latency: Optional[float] = None
+        # main 在 --timings / --trace-file 时替换为启用的 Tracer
+        self.tracer = NULL_TRACER
+        self.plan_cache: Optional[PlanCache] = None
+        if config.get("cache_enabled", True) and config.get("plan_cache_enabled", True):
+            self.plan_cache = PlanCache(
+                path=config.get("cache_path"),
+                max_entries=config.get("plan_cache_max_entries", 500),
+                ttl=config.get("plan_cache_ttl", 86400),
+                synonyms=config.get("plan_cache_synonyms") or {},
+            )
+        self.result_cache = create_result_cache(config)
 
-    def plan_interaction(self, query: str) -> Optional[ActionPlan]:
-        """返回对用户请求的处理计划（对话或命令）"""
-        history = self.get_recent_history()
-        skill_result = self.skill_manager.handle(query, history)
-        if skill_result:
-            return self._plan_from_skill(skill_result)
+    def plan_interaction(
+        self,
+        query: str,
+        on_explanation: Optional[Callable[[str, Optional[str]], None]] = None,
+        on_command: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[ActionPlan]:
+        """返回对用户请求的处理计划（对话或命令）
 
-        prompt = self._build_plan_prompt(query, history)
+        提供 on_explanation 或 on_command 时以流式方式调用 LLM：explanation
+        字段的文本会在到达时逐段回调 (text, intent)；intent 为 run_command
+        且 command 字段闭合时立即回调 on_command(command)，调用方可借此在
+        模型输出其余字段的同时开始执行。
+        """
+        ready_plan, prompt = self._prepare_plan(query)
+        if ready_plan:
+            return ready_plan
         
         try:
-            response = self.llm_client.generate(prompt)
+            if on_explanation or on_command:
+                plan = self._stream_plan(prompt, on_explanation, on_command)
+            else:
+                with self.tracer.span("planner_llm"):
+                    response = self.llm_client.generate(prompt)
+                with self.tracer.span("plan_parse"):
+                    plan = self._parse_plan_response(response)
+            self._remember_plan(query, plan)
+            return plan
+        except Exception as e:
+            if os.getenv("TRAE_DEBUG") == "1":
+                traceback.print_exc()
+            print(f"生成命令时出错: {e}", file=sys.stderr)
+            return None
+
+    async def aplan_interaction(self, query: str) -> Optional[ActionPlan]:
+        """plan_interaction 的异步版本，可与其他 LLM 调用并发执行"""
+        ready_plan, prompt = self._prepare_plan(query)
+        if ready_plan:
+            return ready_plan
+
+        try:
+            response = await self.llm_client.agenerate(prompt)
             plan = self._parse_plan_response(response)
+            self._remember_plan(query, plan)
             return plan
         except Exception as e:
             if os.getenv("TRAE_DEBUG") == "1":
                 traceback.print_exc()
             print(f"生成命令时出错: {e}", file=sys.stderr)
             return None
+
+    def _stream_plan(
+        self,
+        prompt: str,
+        on_explanation: Optional[Callable[[str, Optional[str]], None]],
+        on_command: Optional[Callable[[str], bool]],
+    ) -> ActionPlan:
+        """流式调用 Planner，边接收边解析 JSON
+
+        on_command 返回 True 表示命令已开始执行：此后规划固定为这条单命令
+        （忽略随后出现的 steps），即使流在之后中断或 JSON 不完整，也按已
+        收到的字段返回规划，保证调用方能等待并记录这次执行。
+        """
+        dispatched = False
+
+        def on_string(key: str, text: str) -> None:
+            if key == "explanation" and on_explanation:
+                on_explanation(text, parser.fields.get("intent"))
+
+        def on_field(key: str, value: Any) -> None:
+            nonlocal dispatched
+            if (
+                key == "command" and on_command and not dispatched
+                and parser.fields.get("intent") == "run_command"
+                and isinstance(value, str) and value.strip()
+            ):
+                dispatched = bool(on_command(value.strip()))
+
+        parser = JsonObjectStreamParser(on_field=on_field, on_string=on_string)
+        parse_time = 0.0
+        parse_failed = False
+
+        def feed(chunk: str) -> None:
+            # 解析与模型生成交错进行，单独累计解析耗时
+            nonlocal parse_time, parse_failed
+            if parse_failed:
+                return
+            start = time.perf_counter()
+            try:
+                parser.feed(chunk)
+            except json.JSONDecodeError:
+                # 不是 JSON 规划（如含 { 的 awk 命令），继续接收全文，结束后按非流式路径解析
+                parse_failed = True
+            parse_time += time.perf_counter() - start
+
+        try:
+            with self.tracer.span("planner_llm", stream=True) as span:
+                try:
+                    response = self._generate_streaming(prompt, feed)
+                finally:
+                    if self.first_token_latency is not None:
+                        span.set(ttft_ms=self.first_token_latency * 1000)
+        except Exception:
+            if not dispatched:
+                raise
+            response = ""
+        start = time.perf_counter()
+        try:
+            if dispatched:
+                fields = dict(parser.fields, command=parser.fields["command"].strip())
+                fields.pop("steps", None)
+                return self._plan_from_data(fields)
+            if parser.done:
+                return self._plan_from_data(parser.fields)
+            return self._parse_plan_response(response)
+        finally:
+            self.tracer.add("plan_parse", parse_time + time.perf_counter() - start, early=dispatched)
+
+    def _prepare_plan(self, query: str) -> Tuple[Optional[ActionPlan], str]:
+        """依次尝试技能与规划缓存；均未命中时返回 Planner 提示词"""
+        tracer = self.tracer
+        with tracer.span("history_load") as span:
+            history = self.context_manager.load() if self.context_manager else []
+            span.set(entries=len(history))
+        with tracer.span("skills") as span:
+            skill_result = self.skill_manager.handle(query, history)
+            span.set(hit=bool(skill_result))
+        if skill_result:
+            return self._plan_from_skill(skill_result), ""
+        with tracer.span("plan_cache") as span:
+            cached = self._cached_plan(query)
+            span.set(hit=bool(cached))
+        if cached:
+            return cached, ""
+        with tracer.span("prompt_build") as span:
+            prompt = self._build_plan_prompt(query, self._select_context(query, history))
+            span.set(chars=len(prompt))
+        return None, prompt
+
+    def _select_context(self, query: str, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """relevant 策略下只保留与查询最相关的记录和最近几轮，其余不进入提示词"""
+        if not self.retriever:
+            return history
+        return self.retriever.select(query, history)
+
+    def _cached_plan(self, query: str) -> Optional[ActionPlan]:
+        """从规划缓存中恢复 ActionPlan"""
+        if not self.plan_cache:
+            return None
+        data = self.plan_cache.get_plan(query)
+        if not data:
+            return None
+        try:
+            plan = ActionPlan(**data)
+        except TypeError:
+            return None
+        plan.from_cache = True
+        return plan
+
+    def _remember_plan(self, query: str, plan: ActionPlan) -> None:
+        """只缓存可直接执行的命令规划；对话类回复依赖上下文，不缓存"""
+        if not self.plan_cache or plan.intent != "run_command" or not plan.command:
+            return
+        data = asdict(plan)
+        data.pop("from_cache", None)
+        self.plan_cache.put_plan(query, data)
+
+    def forget_plan(self, query: str) -> bool:
+        """使单条查询的规划缓存失效"""
+        if not self.plan_cache:
+            return False
+        return self.plan_cache.invalidate_query(query)
     
+    def _generate_streaming(self, prompt: str, on_chunk: Callable[[str], None]) -> str:
+        """流式调用 LLM，记录首个 token 延迟并返回完整文本"""
+        self.first_token_latency = None
+        start = time.perf_counter()
+        parts: List[str] = []
+        for chunk in self.llm_client.generate_stream(prompt):
+            if self.first_token_latency is None:
+                self.first_token_latency = time.perf_counter() - start
+            parts.append(chunk)
+            on_chunk(chunk)
+        return "".join(parts)
+
+    def start_session(self) -> None:
+        """交互式会话：历史常驻内存，写盘转入后台线程"""
+        if self.context_manager:
+            self.context_manager.start_background_flush()
+
+    def close(self) -> None:
+        """结束会话，等待历史写盘完成"""
+        if self.context_manager:
+            self.context_manager.close()
+
     def get_recent_history(self) -> List[Dict[str, str]]:
-        """返回最近的上下文"""
+        """返回最近的 context_window 条上下文"""
         if not self.context_manager:
             return []
-        return self.context_manager.load()
+        return self.context_manager.load()[-self.context_window :]
     
-    def record_interaction(self, query: str, command: str, output: Optional[str]) -> None:
-        """记录一次交互"""
+    def record_interaction(
+        self,
+        query: str,
+        command: str,
+        output: Optional[str],
+        usage: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """记录一次交互；usage 为命令的资源消耗，供 trae stats 使用"""
         if not self.context_manager:
             return
-        self.context_manager.add_entry(query, command, output)
+        with self.tracer.span("history_write"):
+            self.context_manager.add_entry(query, command, output, usage)
     
     def _plan_from_skill(self, skill_result) -> ActionPlan:
         """将技能结果转换为 ActionPlan"""
@@ -109,6 +286,7 @@ class CommandAgent:
             explanation=skill_result.explanation,
             needs_summary=bool(skill_result.needs_summary),
             skill_origin=intent,
+            cache_ttl=skill_result.cache_ttl,
         )
 
     def _build_plan_prompt(self, query: str, history: Optional[List[Dict[str, str]]] = None) -> str:
@@ -122,11 +300,14 @@ class CommandAgent:
   "intent": "chat_reply" | "run_command" | "ask_clarification",
   "explanation": "向用户描述你将做什么或回答内容",
   "command": "当 intent=run_command 时需要执行的命令",
+  "steps": [{{"id": "步骤ID", "command": "命令", "depends_on": ["前置步骤ID"]}}],
   "needs_summary": true or false
 }}
 
 若 intent=chat_reply，仅填写 explanation（必要时附加 response 字段）；若需要澄清，intent=ask_clarification 并在 explanation 中提出问题。
 命令必须是安全、单行且可直接在 shell 中运行。
+只需一条命令时填写 command 并省略 steps；需要多条命令时（例如检查系统健康需要 free、df、uptime、ss）改用 steps，
+互不依赖的步骤会并行执行，只有确实需要前一步结果时才填写 depends_on，不要把多条命令用 && 串成一行。
 
 历史上下文：
 {history_section}
@@ -155,19 +336,7 @@ class CommandAgent:
         cleaned = re.sub(r'```$', '', cleaned).strip()
 
         try:
-            data = json.loads(cleaned)
-            intent = str(data.get("intent", "run_command")).strip() or "run_command"
-            explanation = data.get("explanation")
-            command = data.get("command")
-            needs_summary = bool(data.get("needs_summary", intent == "run_command"))
-            response_text = data.get("response")
-            return ActionPlan(
-                intent=intent,
-                explanation=explanation,
-                command=command,
-                needs_summary=needs_summary,
-                response=response_text,
-            )
+            return self._plan_from_data(parse_json_object(cleaned))
         except json.JSONDecodeError:
             command = self._extract_command_like(cleaned)
             if command:
@@ -179,6 +348,43 @@ class CommandAgent:
                 )
             raise
 
+    def _plan_from_data(self, data: Dict[str, Any]) -> ActionPlan:
+        """将解析出的 JSON 字段转换为 ActionPlan"""
+        intent = str(data.get("intent", "run_command")).strip() or "run_command"
+        command = data.get("command")
+        steps = self._parse_steps(data.get("steps"))
+        if len(steps) == 1:
+            command, steps = steps[0].command, []
+        elif steps:
+            command = command or " ; ".join(step.command for step in steps)
+        return ActionPlan(
+            intent=intent,
+            explanation=data.get("explanation"),
+            command=command,
+            needs_summary=bool(data.get("needs_summary", intent == "run_command")),
+            response=data.get("response"),
+            steps=steps,
+        )
+
+    def _parse_steps(self, raw: Any) -> List[PlanStep]:
+        """解析多步骤规划，缺少 id 时按顺序编号"""
+        if not isinstance(raw, list):
+            return []
+        steps = []
+        for index, item in enumerate(raw, 1):
+            if not isinstance(item, dict) or not str(item.get("command") or "").strip():
+                continue
+            depends_on = item.get("depends_on") or []
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            steps.append(PlanStep(
+                id=str(item.get("id") or f"s{index}"),
+                command=str(item["command"]).strip(),
+                depends_on=[str(dep) for dep in depends_on],
+            ))
+        validate_steps(steps)
+        return steps
+
     def _extract_command_like(self, response: str) -> Optional[str]:
         """兼容旧模型输出，提取首行命令"""
         lines = [line.strip() for line in response.splitlines() if line.strip()]
@@ -189,58 +395,108 @@ class CommandAgent:
     
     def is_dangerous_command(self, command: str) -> bool:
         """检查命令是否危险"""
-        command_lower = command.lower()
-        for pattern in self.DANGEROUS_PATTERNS:
-            if re.search(pattern, command_lower):
-                return True
-        return False
+        return is_dangerous_command(command)
     
-    def execute_command(self, command: str) -> CommandResult:
+    def execute_plan(self, plan: ActionPlan, echo: Optional[bool] = None) -> CommandResult:
+        """执行规划：多步骤规划按依赖关系并发执行并合并结果"""
+        if not plan.steps:
+            return self.execute_command(plan.command, echo=echo, cache_ttl=plan.cache_ttl)
+        return execute_steps(self, plan, self.config.get("exec_concurrency", 4), echo)
+
+    def execute_command(
+        self,
+        command: str,
+        echo: Optional[bool] = None,
+        cache_ttl: Optional[int] = None,
+        soft_deadline: Optional[float] = None,
+    ) -> CommandResult:
         """
         执行命令
         
         Args:
             command: 要执行的命令
+            echo: 是否将输出实时打印到终端，默认取配置 stream_output
+            cache_ttl: 结果缓存秒数，默认由只读命令白名单决定
+            soft_deadline: 软截止秒数，默认取配置 command_soft_deadline，0 表示关闭
             
         Returns:
             CommandResult 对象
         """
+        return execute_cached(self, command, echo, cache_ttl, soft_deadline)
+
+    def summarize_result(
+        self,
+        query: str,
+        plan: ActionPlan,
+        result: CommandResult,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> Optional[str]:
+        """根据命令输出生成自然语言总结（提供 on_token 时流式输出）"""
+        prompt = self._build_summary_prompt(query, plan, result)
+        if not prompt:
+            return None
+
         try:
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=self.config.get("command_timeout", 30)
-            )
-            return CommandResult(
-                returncode=result.returncode,
-                stdout=result.stdout,
-                stderr=result.stderr
-            )
-        except subprocess.TimeoutExpired:
-            return CommandResult(
-                returncode=124,
-                stdout="",
-                stderr="命令执行超时"
-            )
-        except Exception as e:
-            return CommandResult(
-                returncode=1,
-                stdout="",
-                stderr=f"执行错误: {e}"
-            )
+            with self.tracer.span("summary_llm", stream=bool(on_token)) as span:
+                if on_token:
+                    summary = self._generate_streaming(prompt, on_token).strip()
+                    span.set(ttft_ms=(self.first_token_latency or 0) * 1000)
+                else:
+                    summary = self.llm_client.generate(prompt).strip()
+            return summary
+        except Exception:
+            if os.getenv("TRAE_DEBUG") == "1":
+                traceback.print_exc()
+            return None
+
+    async def asummarize_result(self, query: str, plan: ActionPlan, result: CommandResult) -> Optional[str]:
+        """summarize_result 的异步版本"""
+        prompt = self._build_summary_prompt(query, plan, result)
+        if not prompt:
+            return None
+
+        try:
+            summary = await self.llm_client.agenerate(prompt)
+            return summary.strip()
+        except Exception:
+            if os.getenv("TRAE_DEBUG") == "1":
+                traceback.print_exc()
+            return None
 
-    def summarize_result(self, query: str, plan: ActionPlan, result: CommandResult) -> Optional[str]:
-        """根据命令输出生成自然语言总结"""
+    async def asummarize_results(
+        self,
+        items: List[Tuple[str, ActionPlan, CommandResult]],
+        concurrency: Optional[int] = None,
+    ) -> List[Optional[str]]:
+        """并发总结多条 (query, plan, result)，返回顺序与输入一致"""
+        limit = max(1, int(concurrency or self.config.get("llm_concurrency", 4)))
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(item: Tuple[str, ActionPlan, CommandResult]) -> Optional[str]:
+            async with semaphore:
+                return await self.asummarize_result(*item)
+
+        return list(await asyncio.gather(*(run(item) for item in items)))
+
+    def summarize_results(
+        self,
+        items: List[Tuple[str, ActionPlan, CommandResult]],
+        concurrency: Optional[int] = None,
+    ) -> List[Optional[str]]:
+        """同步入口：在单个事件循环内并发总结多条结果"""
+        return asyncio.run(self.asummarize_results(items, concurrency))
+
+    def _build_summary_prompt(self, query: str, plan: ActionPlan, result: CommandResult) -> Optional[str]:
+        """构建总结提示词；无需总结或无输出时返回 None"""
         if not plan.needs_summary:
             return None
-        output_text = result.stdout.strip() or result.stderr.strip()
+        limit = 1600
+        output_text = result.excerpt("stdout", limit) or result.excerpt("stderr", limit)
         if not output_text:
             return None
 
-        trimmed = self._truncate_for_summary(output_text)
-        prompt = f"""你是一名终端助手，需要向用户总结命令执行结果。
+        trimmed = self._truncate_for_summary(output_text, limit)
+        return f"""你是一名终端助手，需要向用户总结命令执行结果。
 用户原始请求: {query}
 执行命令: {plan.command}
 命令输出:
@@ -248,14 +504,6 @@ class CommandAgent:
 
 请用简洁的中文总结 1-2 句话，突出关键数字或状态，并说明是否成功。"""
 
-        try:
-            summary = self.llm_client.generate(prompt).strip()
-            return summary
-        except Exception:
-            if os.getenv("TRAE_DEBUG") == "1":
-                traceback.print_exc()
-            return None
-
     def _truncate_for_summary(self, text: str, limit: int = 1600) -> str:
         if len(text) <= limit:
             return text
@@ -263,3 +511,98 @@ class CommandAgent:
         tail = text[-limit // 2 :].lstrip()
         return f"{head}\n...\n{tail}"
 
+
+def create_result_cache(config: Dict[str, Any]) -> Optional[ResultCache]:
+    """按配置创建只读命令结果缓存；--no-cache 或关闭 result_cache_enabled 时返回 None"""
+    if not (config.get("cache_enabled", True) and config.get("result_cache_enabled", True)):
+        return None
+    return ResultCache(path=config.get("cache_path"), max_entries=config.get("result_cache_max_entries", 200))
+
+
+def execute_cached(
+    agent,
+    command: str,
+    echo: Optional[bool] = None,
+    cache_ttl: Optional[int] = None,
+    soft_deadline: Optional[float] = None,
+) -> CommandResult:
+    """执行命令；只读命令的成功结果按 (命令, 工作目录) 缓存 ttl 秒
+
+    CommandAgent 与 RemoteAgent 共用，命令总在调用方进程中执行。命中时直接
+    返回带 cached_at 的结果而不启动进程；result_cache_fresh（--fresh）时跳过
+    读取，但仍写入新结果。输出被截断、溢出到磁盘或转入后台的结果不缓存。
+    """
+    with agent.tracer.span("execute") as span:
+        result = _execute_cached(agent, command, echo, cache_ttl, soft_deadline)
+        span.set(returncode=result.returncode, cached=bool(result.cached_at))
+        if result.usage:
+            span.set(cpu_ms=result.usage.cpu * 1000)
+    return result
+
+
+def _execute_cached(
+    agent,
+    command: str,
+    echo: Optional[bool],
+    cache_ttl: Optional[int],
+    soft_deadline: Optional[float],
+) -> CommandResult:
+    config = agent.config
+    if echo is None:
+        echo = bool(config.get("stream_output", True))
+    ttl = cache_ttl if cache_ttl is not None else read_only_ttl(command)
+    cache = agent.result_cache if ttl else None
+    cwd = ""
+    if cache:
+        try:
+            cwd = os.getcwd()
+        except OSError:
+            cache = None
+    if cache and not config.get("result_cache_fresh"):
+        data = cache.get_result(command, cwd)
+        if data:
+            try:
+                return CommandResult(**data)
+            except TypeError:
+                pass
+
+    result = run_command(
+        command,
+        timeout=config.get("command_timeout", 30),
+        on_output=echo_output if echo else None,
+        capture_bytes=config.get("output_capture_bytes", 1024 * 1024),
+        spill_bytes=config.get("output_spill_bytes", 64 * 1024),
+        kill_grace=config.get("command_kill_grace", 2),
+        soft_deadline=config.get("command_soft_deadline", 0) if soft_deadline is None else soft_deadline,
+        jobs_dir=config.get("jobs_dir"),
+    )
+    incomplete = result.truncated or result.stdout_path or result.stderr_path or result.background_pid
+    if cache and result.returncode == 0 and not incomplete:
+        data = asdict(result)
+        data.update(streamed=False, cached_at=time.time(), usage=None)
+        cache.put_result(command, cwd, data, ttl)
+    return result
+
+
+def execute_steps(agent, plan: ActionPlan, max_workers: int, echo: Optional[bool] = None) -> CommandResult:
+    """并发执行多步骤规划
+
+    各步骤的输出先各自捕获，完成后按完成顺序整体打印，避免多个命令的
+    输出交错；合并结果只保留供总结与历史使用的摘录。
+    """
+    if echo is None:
+        echo = bool(agent.config.get("stream_output", True))
+    start = time.perf_counter()
+    with agent.tracer.span("execute_steps", steps=len(plan.steps)):
+        results = run_plan_steps(
+            plan.steps,
+            # 后续步骤依赖前序步骤完成，步骤不转入后台
+            lambda command: agent.execute_command(command, echo=False, soft_deadline=0),
+            max_workers,
+            on_done=print_step_result if echo else None,
+        )
+    try:
+        return merge_step_results(plan.steps, results, streamed=echo, wall=time.perf_counter() - start)
+    finally:
+        for result in results:
+            result.cleanup()
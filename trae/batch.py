@@ -0,0 +1,144 @@
+"""
+批处理模式 - 从文件或标准输入读取多条查询，并发规划与执行，按输入顺序输出 JSONL
+"""
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, TextIO
+
+from trae.executor import CommandResult
+from trae.plan import ActionPlan
+
+
+def read_queries(stream: Iterable[str]) -> List[str]:
+    """每行一条查询，忽略空行与 # 开头的注释"""
+    queries = []
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            queries.append(line)
+    return queries
+
+
+def run_batch(
+    agent,
+    queries: List[str],
+    output: TextIO = sys.stdout,
+    llm_concurrency: Optional[int] = None,
+    exec_concurrency: Optional[int] = None,
+    dry_run: bool = False,
+) -> int:
+    """处理全部查询并返回退出码：全部成功为 0，否则为 1
+
+    LLM 调用（规划与总结）与命令执行分别限流：前者是事件循环中的
+    信号量，后者是独立的线程池。结果按输入顺序逐行写出，前面的查询
+    完成后立即输出，不必等待整个批次结束。
+    """
+    runner = _BatchRunner(
+        agent,
+        llm_concurrency or agent.config.get("llm_concurrency", 4),
+        exec_concurrency or agent.config.get("exec_concurrency", 4),
+        dry_run,
+    )
+    return asyncio.run(runner.run(queries, output))
+
+
+class _BatchRunner:
+    def __init__(self, agent, llm_concurrency: int, exec_concurrency: int, dry_run: bool) -> None:
+        self.agent = agent
+        self.llm_concurrency = max(1, int(llm_concurrency))
+        self.exec_concurrency = max(1, int(exec_concurrency))
+        self.dry_run = dry_run
+        self.output_limit = agent.config.get("context_output_limit", 2000)
+
+    async def run(self, queries: List[str], output: TextIO) -> int:
+        self.llm_slots = asyncio.Semaphore(self.llm_concurrency)
+        failures = 0
+        with ThreadPoolExecutor(max_workers=self.exec_concurrency, thread_name_prefix="trae-batch") as pool:
+            self.pool = pool
+            tasks = [asyncio.ensure_future(self.process(index, query)) for index, query in enumerate(queries)]
+            for task in tasks:
+                record = await task
+                if record["status"] not in ("ok", "dry-run", "background"):
+                    failures += 1
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+        return 1 if failures else 0
+
+    async def process(self, index: int, query: str) -> Dict[str, Any]:
+        start = time.perf_counter()
+        record: Dict[str, Any] = {"index": index, "query": query}
+        try:
+            await self._process(query, record)
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = str(e)
+        record["duration"] = round(time.perf_counter() - start, 3)
+        return record
+
+    async def _process(self, query: str, record: Dict[str, Any]) -> None:
+        agent = self.agent
+        async with self.llm_slots:
+            plan = await agent.aplan_interaction(query)
+        if not plan:
+            record.update(status="error", error="无法生成有效的行动计划")
+            return
+        record["intent"] = plan.intent
+
+        if plan.intent in ("chat_reply", "ask_clarification"):
+            reply = plan.response or plan.explanation or ""
+            record.update(status="ok", response=reply)
+            agent.record_interaction(query, "[chat]" if plan.intent == "chat_reply" else "[clarification]", reply)
+            return
+        if plan.intent != "run_command" or not plan.command:
+            record.update(status="error", error=f"无法执行的规划: {plan.intent}")
+            return
+
+        record["command"] = plan.command
+        if plan.steps:
+            record["steps"] = [{"id": step.id, "command": step.command, "depends_on": step.depends_on} for step in plan.steps]
+        if self.dry_run:
+            record["status"] = "dry-run"
+            agent.record_interaction(query, plan.command, "[dry-run]")
+            return
+        commands = [step.command for step in plan.steps] or [plan.command]
+        if any(agent.is_dangerous_command(command) for command in commands):
+            # 批处理无法交互确认，危险命令一律跳过
+            record.update(status="skipped", reason="dangerous")
+            return
+
+        loop = asyncio.get_running_loop()
+        result: CommandResult = await loop.run_in_executor(self.pool, self._execute, plan)
+        try:
+            if result.background_pid:
+                record.update(status="background", pid=result.background_pid, job_log=result.job_log)
+                record["stdout"] = result.excerpt("stdout", self.output_limit)
+                agent.record_interaction(query, plan.command, f"[后台运行 PID {result.background_pid}]\n{record['stdout']}".strip())
+                return
+            record["returncode"] = result.returncode
+            if result.timed_out:
+                record["timed_out"] = True
+            if result.cached_at:
+                record["cached"] = True
+            record["stdout"] = result.excerpt("stdout", self.output_limit)
+            if result.stderr:
+                record["stderr"] = result.excerpt("stderr", self.output_limit)
+            log_output = record["stdout"] if result.returncode == 0 else (record.get("stderr") or record["stdout"])
+            if result.returncode == 0:
+                async with self.llm_slots:
+                    summary = await agent.asummarize_result(query, plan, result)
+                if summary:
+                    record["summary"] = summary
+                    log_output = f"{summary}\n\n{log_output}".strip()
+        finally:
+            result.cleanup()
+        record["status"] = "ok" if result.returncode == 0 else "failed"
+        usage = result.usage.to_dict() if result.usage else None
+        if usage:
+            record["usage"] = usage
+        agent.record_interaction(query, plan.command, log_output or None, usage)
+
+    def _execute(self, plan: ActionPlan) -> CommandResult:
+        return self.agent.execute_plan(plan, echo=False)
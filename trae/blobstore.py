@@ -0,0 +1,95 @@
+"""
+内容寻址存储 - 按 SHA-256 去重、zlib 压缩保存较大的命令输出
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import Collection, Optional
+
+
+class BlobStore:
+    """以内容哈希为键的压缩文件存储
+
+    blob 存放在 root/<前两位>/<其余哈希> 中；相同内容只写一次。写入先落到
+    临时文件再 rename，并发写入同一 blob 也不会读到半个文件。
+
+    不再被引用的 blob 由 sweep() 回收。put() 命中已有 blob 时会刷新其 mtime，
+    sweep() 跳过近期写入的 blob，因此刚写入、引用它的记录还没来得及追加时
+    不会被误删。
+    """
+
+    def __init__(self, root: Optional[str] = None, level: int = 6) -> None:
+        self.root = Path(root) if root else Path.home() / ".trae" / "blobs"
+        self.level = level
+
+    def _path(self, ref: str) -> Path:
+        return self.root / ref[:2] / ref[2:]
+
+    def put(self, text: str) -> Optional[str]:
+        """保存文本并返回引用（SHA-256 十六进制）；写入失败时返回 None"""
+        data = text.encode("utf-8")
+        ref = hashlib.sha256(data).hexdigest()
+        path = self._path(ref)
+        if path.exists():
+            try:
+                os.utime(path)
+                return ref
+            except OSError:
+                pass
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data, self.level))
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            return None
+        return ref
+
+    def get(self, ref: str) -> Optional[str]:
+        """读取引用对应的文本；不存在或已损坏时返回 None"""
+        if not isinstance(ref, str) or len(ref) != 64:
+            return None
+        try:
+            with open(self._path(ref), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except (OSError, zlib.error, UnicodeDecodeError):
+            return None
+
+    def sweep(self, live: Collection[str], min_age: float = 600) -> int:
+        """删除不在 live 中且 min_age 秒内未写入的 blob（以及残留的临时文件），返回删除数量"""
+        cutoff = time.time() - min_age
+        removed = 0
+        try:
+            buckets = [bucket for bucket in self.root.iterdir() if bucket.is_dir() and len(bucket.name) == 2]
+        except OSError:
+            return 0
+        for bucket in buckets:
+            try:
+                paths = list(bucket.iterdir())
+            except OSError:
+                continue
+            for path in paths:
+                ref = bucket.name + path.name
+                if ref in live:
+                    continue
+                try:
+                    if path.stat().st_mtime > cutoff:
+                        continue
+                    path.unlink()
+                    removed += 1
+                except OSError:
+                    continue
+            try:
+                bucket.rmdir()
+            except OSError:
+                pass
+        return removed
@@ -0,0 +1,228 @@
+"""
+本地缓存 - 基于 SQLite 的持久化 TTL + LRU 缓存
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+def default_cache_path() -> Path:
+    """默认缓存文件 ~/.trae/cache.sqlite3"""
+    return Path.home() / ".trae" / "cache.sqlite3"
+
+
+class SqliteCache:
+    """按表划分的持久化缓存
+
+    每条记录带独立的过期时间；超过 max_entries 时按最近访问时间淘汰。
+    缓存只是加速手段，任何 SQLite/文件错误都会被吞掉并视为未命中。
+    """
+
+    def __init__(
+        self,
+        table: str,
+        path: Optional[str] = None,
+        max_entries: int = 1000,
+        ttl: float = 86400,
+    ) -> None:
+        self.table = table
+        self.path = Path(path) if path else default_cache_path()
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created REAL NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table}(accessed)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        """读取未过期的记录并刷新访问时间"""
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute(
+                    f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                value, expires = row
+                if expires <= now:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    conn.commit()
+                    return None
+                conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                conn.commit()
+                return value
+            except (sqlite3.Error, OSError):
+                return None
+
+    def put(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        """写入记录，必要时淘汰最久未访问的条目"""
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else float(ttl))
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, expires, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, value, now, expires, now),
+                )
+                (count,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+                if count > self.max_entries:
+                    conn.execute(
+                        f"DELETE FROM {self.table} WHERE key IN ("
+                        f"SELECT key FROM {self.table} ORDER BY accessed ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+                conn.commit()
+            except (sqlite3.Error, OSError):
+                pass
+
+    def invalidate(self, key: str) -> bool:
+        """删除单条记录，返回是否存在"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                cursor = conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                conn.commit()
+                return cursor.rowcount > 0
+            except (sqlite3.Error, OSError):
+                return False
+
+    def clear(self) -> None:
+        """清空本表"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute(f"DELETE FROM {self.table}")
+                conn.commit()
+            except (sqlite3.Error, OSError):
+                pass
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ResponseCache(SqliteCache):
+    """LLM 响应缓存，键由提供商、模型、温度与提示词哈希组成"""
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 1000, ttl: float = 86400) -> None:
+        super().__init__("llm_responses", path=path, max_entries=max_entries, ttl=ttl)
+
+    @staticmethod
+    def make_key(provider: str, model: str, temperature: Any, prompt: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        raw = json.dumps([provider, model, temperature, prompt_hash], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class PlanCache(SqliteCache):
+    """查询 -> ActionPlan 快速路径缓存
+
+    查询先做规范化（NFKC、大小写折叠、空白折叠、去掉结尾标点），再按
+    synonyms 规则替换同义表达，使“查询内存使用情况”“ 查询内存使用情况？”
+    命中同一条记录。
+    """
+
+    _TRAILING_PUNCTUATION = "?？!！。.,，~～ "
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = 500,
+        ttl: float = 86400,
+        synonyms: Optional[Dict[str, str]] = None,
+    ) -> None:
+        super().__init__("plans", path=path, max_entries=max_entries, ttl=ttl)
+        rules = synonyms or {}
+        # 先替换较长的短语，避免被其子串规则抢先匹配
+        self.synonyms = sorted(
+            ((self._fold(source), self._fold(target)) for source, target in rules.items() if source),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+
+    _CJK_SPACING = re.compile(r"\s*([\u2e80-\u9fff\u3000-\u303f\uac00-\ud7af])\s*")
+
+    @classmethod
+    def _fold(cls, text: str) -> str:
+        text = unicodedata.normalize("NFKC", str(text)).casefold()
+        text = re.sub(r"\s+", " ", text).strip()
+        # 中日韩文字之间的空格不影响语义
+        return cls._CJK_SPACING.sub(r"\1", text)
+
+    def normalize(self, query: str) -> str:
+        """返回用作缓存键的规范化查询"""
+        normalized = self._fold(query).rstrip(self._TRAILING_PUNCTUATION)
+        for source, target in self.synonyms:
+            normalized = normalized.replace(source, target)
+        return normalized
+
+    def get_plan(self, query: str) -> Optional[Dict[str, Any]]:
+        raw = self.get(self.normalize(query))
+        if raw is None:
+            return None
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def put_plan(self, query: str, plan: Dict[str, Any]) -> None:
+        self.put(self.normalize(query), json.dumps(plan, ensure_ascii=False))
+
+    def invalidate_query(self, query: str) -> bool:
+        return self.invalidate(self.normalize(query))
+
+
+class ResultCache(SqliteCache):
+    """只读命令的执行结果缓存，键由命令文本与工作目录组成
+
+    过期时间由调用方按命令逐条指定；值中记录执行时间，便于提示结果新旧。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 200) -> None:
+        super().__init__("command_results", path=path, max_entries=max_entries, ttl=0)
+
+    @staticmethod
+    def make_key(command: str, cwd: str) -> str:
+        raw = json.dumps([command, cwd], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get_result(self, command: str, cwd: str) -> Optional[Dict[str, Any]]:
+        raw = self.get(self.make_key(command, cwd))
+        if raw is None:
+            return None
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def put_result(self, command: str, cwd: str, result: Dict[str, Any], ttl: float) -> None:
+        self.put(self.make_key(command, cwd), json.dumps(result, ensure_ascii=False), ttl=ttl)
@@ -15,6 +15,14 @@ def _parse_int(value: Any, default: int) -> int:
         return default
 
 
+def _parse_float(value: Any, default: float) -> float:
+    """安全地将值转换为 float"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
 def get_config() -> Dict[str, Any]:
     """获取配置"""
     config = {
@@ -22,17 +30,53 @@ def get_config() -> Dict[str, Any]:
         "model": "gpt-3.5-turbo",
         "api_key": None,
         "command_timeout": 30,
+        "command_kill_grace": 2,  # 超时后先 SIGTERM 整个进程组，该秒数后仍未退出再 SIGKILL
+        "command_soft_deadline": 0,  # 秒；>0 时命令运行超过该时间即返回部分输出，命令在后台继续运行
+        "jobs_dir": None,  # 软截止模式的输出日志目录，默认 ~/.trae/jobs
         "ollama_url": "http://localhost:11434/api/generate",
         "dashscope_base_url": None,  # 可选，自定义 DashScope API 地址
         "context_window": 50,
         "context_history_path": None,
         "context_output_limit": 2000,
+        "context_strategy": "relevant",  # relevant：BM25 相关记录 + 最近几轮；recent：最近 context_window 条
+        "context_top_k": 5,
+        "context_recent": 3,
+        "context_retrieval_window": 500,  # relevant 策略下参与 BM25 排序（并在 JSONL 中保留）的最近记录数
+        "history_fsync": "never",  # never / always：每次追加历史后是否 fsync
+        "history_compact_bytes": 1024 * 1024,  # 历史文件超过该大小时压缩到 context_window 条
+        "history_blob_threshold": 512,  # 超过该字符数的输出存入 ~/.trae/blobs（压缩、去重），0 表示始终内联
+        "history_shard": "none",  # none / tty / session：按终端或会话拆分 JSONL 历史
+        "history_shard_max_age": 30 * 86400,  # 秒；压缩时删除超过该时长未写入的其他分片，0 表示不限
+        "history_backend": "jsonl",  # jsonl / sqlite：sqlite 保留全部历史并支持全文检索
+        "history_db_path": None,  # 默认 ~/.trae/history.sqlite3
+        "stream": True,  # 流式输出规划说明与总结
+        "stream_output": True,  # 命令输出实时打印到终端
+        "early_execution": True,  # 流式规划中 command 字段闭合后立即开始执行，不等待其余字段
+        "output_capture_bytes": 1024 * 1024,  # 每个输出流最多保留的字节数（开头与结尾各一半），用于历史与总结
+        "output_spill_bytes": 64 * 1024,  # 捕获超过该大小时写入临时文件并按需 mmap 读取，0 表示始终保存在内存
+        "llm_concurrency": 4,  # 异步批量调用 LLM 时的最大并发数
+        "exec_concurrency": 4,  # 多步骤规划中同时执行的命令数
+        "temperature": 0.3,
+        "cache_enabled": True,  # LLM 响应缓存（~/.trae/cache.sqlite3）
+        "cache_path": None,
+        "cache_ttl": 86400,  # 秒
+        "cache_max_entries": 1000,
+        "plan_cache_enabled": True,  # 常见查询直接复用上次的规划，跳过 Planner
+        "plan_cache_ttl": 86400,
+        "plan_cache_max_entries": 500,
+        "plan_cache_synonyms": {},  # 例如 {"磁盘空间": "磁盘使用情况"}
+        "result_cache_enabled": True,  # 只读命令（lscpu、lsblk 等）的执行结果按命令与工作目录缓存
+        "result_cache_max_entries": 200,
+        "fallback_providers": [],  # 主提供商失败时依次尝试，例如 [{"provider": "local", "model": "qwen2"}]
+        "hedge_delay": 0,  # 秒；>0 时主提供商超时未返回即并行请求下一个提供商
     }
     
     # 从环境变量读取
     config["api_key"] = os.getenv("TRAE_API_KEY", config["api_key"])
     config["provider"] = os.getenv("TRAE_PROVIDER", config["provider"])
     config["model"] = os.getenv("TRAE_MODEL", config["model"])
+    if os.getenv("TRAE_NO_CACHE") == "1":
+        config["cache_enabled"] = False
     
     context_env = os.getenv("TRAE_CONTEXT_WINDOW")
     if context_env is not None:
@@ -53,6 +97,32 @@ def get_config() -> Dict[str, Any]:
     
     config["context_window"] = max(1, _parse_int(config.get("context_window"), 50))
     config["context_output_limit"] = max(200, _parse_int(config.get("context_output_limit"), 2000))
+    config["history_compact_bytes"] = max(4096, _parse_int(config.get("history_compact_bytes"), 1024 * 1024))
+    if config.get("context_strategy") not in ("relevant", "recent"):
+        config["context_strategy"] = "relevant"
+    config["context_top_k"] = max(0, _parse_int(config.get("context_top_k"), 5))
+    config["context_recent"] = max(0, _parse_int(config.get("context_recent"), 3))
+    config["context_retrieval_window"] = max(1, _parse_int(config.get("context_retrieval_window"), 500))
+    if config.get("history_shard") not in ("none", "tty", "session"):
+        config["history_shard"] = "none"
+    config["history_shard_max_age"] = max(0, _parse_int(config.get("history_shard_max_age"), 30 * 86400))
+    if config.get("history_backend") not in ("jsonl", "sqlite"):
+        config["history_backend"] = "jsonl"
+    config["history_blob_threshold"] = max(0, _parse_int(config.get("history_blob_threshold"), 512))
+    config["output_capture_bytes"] = max(4096, _parse_int(config.get("output_capture_bytes"), 1024 * 1024))
+    config["output_spill_bytes"] = max(0, _parse_int(config.get("output_spill_bytes"), 64 * 1024))
+    config["llm_concurrency"] = max(1, _parse_int(config.get("llm_concurrency"), 4))
+    config["exec_concurrency"] = max(1, _parse_int(config.get("exec_concurrency"), 4))
+    config["cache_ttl"] = max(0, _parse_int(config.get("cache_ttl"), 86400))
+    config["cache_max_entries"] = max(1, _parse_int(config.get("cache_max_entries"), 1000))
+    config["plan_cache_ttl"] = max(0, _parse_int(config.get("plan_cache_ttl"), 86400))
+    config["plan_cache_max_entries"] = max(1, _parse_int(config.get("plan_cache_max_entries"), 500))
+    config["result_cache_max_entries"] = max(1, _parse_int(config.get("result_cache_max_entries"), 200))
+    config["hedge_delay"] = max(0.0, _parse_float(config.get("hedge_delay"), 0.0))
+    config["command_kill_grace"] = max(0.0, _parse_float(config.get("command_kill_grace"), 2.0))
+    config["command_soft_deadline"] = max(0.0, _parse_float(config.get("command_soft_deadline"), 0.0))
+    if not isinstance(config.get("fallback_providers"), list):
+        config["fallback_providers"] = []
     
     return config
 
@@ -0,0 +1,433 @@
+"""
+常驻守护进程 - 通过 Unix 套接字复用已预热的 CommandAgent
+
+守护进程负责规划、总结、危险检测与历史记录（LLM 客户端、配置和历史
+都常驻内存）；命令本身仍由客户端在自己的工作目录、环境与终端中执行。
+协议为逐行 JSON：客户端每次连接发送一个请求，服务端返回若干事件行，
+最后一行是 {"event": "result", ...} 或 {"event": "error", ...}。
+"""
+import copy
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from trae.executor import CommandResult
+from trae.plan import ActionPlan
+from trae.safety import is_dangerous_command
+from trae.tracing import NULL_TRACER, Tracer
+
+
+def default_socket_path(config: Optional[Dict[str, Any]] = None) -> Path:
+    """守护进程套接字路径，默认 ~/.trae/daemon.sock"""
+    configured = (config or {}).get("daemon_socket") or os.getenv("TRAE_DAEMON_SOCKET")
+    if configured:
+        return Path(configured).expanduser()
+    return Path.home() / ".trae" / "daemon.sock"
+
+
+def apply_overrides(config: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """将命令行覆盖项合并进配置（守护进程与进程内执行共用）"""
+    merged = dict(config)
+    for key, value in overrides.items():
+        if value is not None:
+            merged[key] = value
+    return merged
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """处理单个客户端请求"""
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            op = request.get("op")
+            handler = getattr(self.server.trae_daemon, f"op_{op}", None)
+            if handler is None:
+                raise ValueError(f"未知操作: {op}")
+            result = handler(request, self._send_event)
+            self._send({"event": "result", "result": result})
+        except Exception as e:
+            if os.getenv("TRAE_DEBUG") == "1":
+                traceback.print_exc()
+            self._send({"event": "error", "message": str(e)})
+
+    def _send_event(self, event: str, **payload: Any) -> None:
+        payload["event"] = event
+        self._send(payload)
+
+    def _send(self, payload: Dict[str, Any]) -> None:
+        try:
+            self.wfile.write(json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+        except OSError:
+            pass
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TraeDaemon:
+    """持有预热的 CommandAgent，按命令行覆盖项分别缓存
+
+    规划与总结并发处理：每个请求使用代理的浅拷贝，tracer 与首个 token
+    延迟只属于本次请求，LLM 客户端、历史与缓存则共享（它们各自加锁）。
+    每个代理配的锁只在写入历史时持有。
+
+    history_shard 的分片名由客户端按自己的终端/会话算出并随请求发送；
+    每个分片一个会话，与基础代理共用 LLM 客户端与缓存，只是历史管理器
+    与检索索引各自独立。
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self._agents: Dict[str, Tuple[Any, threading.Lock]] = {}
+        self._lock = threading.Lock()
+
+    def session(self, overrides: Optional[Dict[str, Any]], shard: Optional[str] = None) -> Tuple[Any, threading.Lock]:
+        from trae.agent import CommandAgent
+        from trae.history import create_context_manager
+        from trae.retrieval import HistoryRetriever
+
+        key = json.dumps(overrides or {}, sort_keys=True)
+        with self._lock:
+            session = self._agents.get(key)
+            if session is None:
+                # 守护进程自己的终端/会话与客户端无关，未带分片的请求写基础文件
+                config = dict(apply_overrides(self.config, overrides or {}), history_shard="none")
+                session = (CommandAgent(config), threading.Lock())
+                self._agents[key] = session
+            if not shard:
+                return session
+            sharded = self._agents.get(f"{key}#{shard}")
+            if sharded is None:
+                agent = copy.copy(session[0])
+                agent.context_manager = create_context_manager(agent.config, agent.history_window, shard=shard)
+                if agent.retriever:
+                    agent.retriever = HistoryRetriever(agent.retriever.top_k, agent.retriever.recent)
+                sharded = (agent, threading.Lock())
+                self._agents[f"{key}#{shard}"] = sharded
+            return sharded
+
+    def op_ping(self, request: Dict[str, Any], send: Callable[..., None]) -> Dict[str, Any]:
+        agent, _ = self.session(request.get("overrides"))
+        return {
+            "pid": os.getpid(),
+            "command_timeout": agent.config.get("command_timeout", 30),
+            "command_kill_grace": agent.config.get("command_kill_grace", 2),
+            "command_soft_deadline": agent.config.get("command_soft_deadline", 0),
+            "jobs_dir": agent.config.get("jobs_dir"),
+            "stream": bool(agent.config.get("stream", True)),
+            "stream_output": bool(agent.config.get("stream_output", True)),
+            "early_execution": bool(agent.config.get("early_execution", True)),
+            "output_capture_bytes": agent.config.get("output_capture_bytes", 1024 * 1024),
+            "output_spill_bytes": agent.config.get("output_spill_bytes", 64 * 1024),
+            "context_output_limit": agent.config.get("context_output_limit", 2000),
+            "exec_concurrency": agent.config.get("exec_concurrency", 4),
+            "cache_enabled": bool(agent.config.get("cache_enabled", True)),
+            "cache_path": agent.config.get("cache_path"),
+            "result_cache_enabled": bool(agent.config.get("result_cache_enabled", True)),
+            "result_cache_max_entries": agent.config.get("result_cache_max_entries", 200),
+            "result_cache_fresh": bool(agent.config.get("result_cache_fresh", False)),
+            "has_api_key": bool(agent.config.get("api_key")),
+            # SQLite 后端不分片
+            "history_shard": (
+                apply_overrides(self.config, request.get("overrides") or {}).get("history_shard", "none")
+                if agent.config.get("history_backend", "jsonl") == "jsonl" else "none"
+            ),
+        }
+
+    def op_plan(self, request: Dict[str, Any], send: Callable[..., None]) -> Dict[str, Any]:
+        agent, _ = self.session(request.get("overrides"), request.get("shard"))
+        query = request["query"]
+        on_explanation = on_command = None
+        if request.get("stream"):
+            on_explanation = lambda text, intent: send("explanation", text=text, intent=intent)
+        if request.get("early"):
+            # 命令在客户端执行，这里只负责尽早转发。客户端会拒绝提前执行危险命令，
+            # 这里按同样的规则判断，使规划结果（是否固定为单命令）与本地模式一致
+            def on_command(command: str) -> bool:
+                if agent.is_dangerous_command(command):
+                    return False
+                send("command", command=command)
+                return True
+        view = _request_view(agent, request)
+        if request.get("replan"):
+            view.forget_plan(query)
+        plan = view.plan_interaction(query, on_explanation=on_explanation, on_command=on_command)
+        return {
+            "plan": asdict(plan) if plan else None,
+            "first_token_latency": view.first_token_latency,
+            "spans": view.tracer.to_dicts() if view.tracer.enabled else None,
+        }
+
+    def op_summarize(self, request: Dict[str, Any], send: Callable[..., None]) -> Dict[str, Any]:
+        agent, _ = self.session(request.get("overrides"), request.get("shard"))
+        plan = ActionPlan(**request["plan"])
+        result = CommandResult(**request["result"])
+        on_token = None
+        if request.get("stream"):
+            on_token = lambda text: send("token", text=text)
+        view = _request_view(agent, request)
+        summary = view.summarize_result(request["query"], plan, result, on_token=on_token)
+        return {
+            "summary": summary,
+            "first_token_latency": view.first_token_latency,
+            "spans": view.tracer.to_dicts() if view.tracer.enabled else None,
+        }
+
+    def op_record(self, request: Dict[str, Any], send: Callable[..., None]) -> None:
+        agent, lock = self.session(request.get("overrides"), request.get("shard"))
+        with lock:
+            agent.record_interaction(request["query"], request["command"], request.get("output"), request.get("usage"))
+
+    def op_dangerous(self, request: Dict[str, Any], send: Callable[..., None]) -> bool:
+        agent, _ = self.session(request.get("overrides"))
+        return agent.is_dangerous_command(request["command"])
+
+
+def _request_view(agent, request: Dict[str, Any]):
+    """本次请求使用的代理浅拷贝：请求带 trace 时启用独立的 Tracer"""
+    view = copy.copy(agent)
+    view.tracer = Tracer() if request.get("trace") else NULL_TRACER
+    view.first_token_latency = None
+    return view
+
+
+def create_server(config: Dict[str, Any], socket_path: Optional[Path] = None) -> "_UnixServer":
+    """创建监听套接字的服务端并预热默认代理；套接字已被占用时抛出 RuntimeError"""
+    path = Path(socket_path or default_socket_path(config))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        if _probe(path):
+            raise RuntimeError(f"守护进程已在运行 ({path})")
+        path.unlink()
+
+    daemon = TraeDaemon(config)
+    daemon.session({})  # 预热默认代理
+    old_umask = os.umask(0o177)
+    try:
+        server = _UnixServer(str(path), _DaemonHandler)
+    finally:
+        os.umask(old_umask)
+    server.trae_daemon = daemon
+    server.socket_path = path
+    return server
+
+
+def serve(config: Dict[str, Any], socket_path: Optional[Path] = None) -> int:
+    """前台运行守护进程，直到收到 SIGINT/SIGTERM"""
+    try:
+        server = create_server(config, socket_path)
+    except RuntimeError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    print(f"trae 守护进程已启动 (pid {os.getpid()})，监听 {server.socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            server.socket_path.unlink()
+        except OSError:
+            pass
+    return 0
+
+
+def _probe(path: Path) -> bool:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(0.5)
+            sock.connect(str(path))
+        return True
+    except OSError:
+        return False
+
+
+class RemoteAgent:
+    """守护进程客户端，提供与 CommandAgent 相同的调用接口"""
+
+    def __init__(self, socket_path: Path, overrides: Dict[str, Any], info: Dict[str, Any]) -> None:
+        from trae.history import shard_key
+
+        self.socket_path = socket_path
+        self.overrides = overrides
+        self.info = info
+        # 分片名取客户端自己的终端/会话，而不是守护进程的
+        self.shard = shard_key(info.get("history_shard"))
+        self.config = {
+            "command_timeout": info.get("command_timeout", 30),
+            "command_kill_grace": info.get("command_kill_grace", 2),
+            "command_soft_deadline": info.get("command_soft_deadline", 0),
+            "jobs_dir": info.get("jobs_dir"),
+            "stream": info.get("stream", True),
+            "stream_output": info.get("stream_output", True),
+            "early_execution": info.get("early_execution", True),
+            "output_capture_bytes": info.get("output_capture_bytes", 1024 * 1024),
+            "output_spill_bytes": info.get("output_spill_bytes", 64 * 1024),
+            "context_output_limit": info.get("context_output_limit", 2000),
+            "exec_concurrency": info.get("exec_concurrency", 4),
+            "cache_enabled": info.get("cache_enabled", True),
+            "cache_path": info.get("cache_path"),
+            "result_cache_enabled": info.get("result_cache_enabled", True),
+            "result_cache_max_entries": info.get("result_cache_max_entries", 200),
+            "result_cache_fresh": info.get("result_cache_fresh", False),
+        }
+        self.result_cache = None
+        self.first_token_latency: Optional[float] = None
+        self.tracer = NULL_TRACER
+        self._replan = False
+
+    def _call(self, request: Dict[str, Any], on_event: Optional[Callable[[Dict[str, Any]], None]] = None) -> Any:
+        request["overrides"] = self.overrides
+        request["shard"] = self.shard
+        for message in _request(self.socket_path, request):
+            event = message.get("event")
+            if event == "result":
+                return message.get("result")
+            if event == "error":
+                raise RuntimeError(message.get("message") or "守护进程返回错误")
+            if on_event:
+                on_event(message)
+        raise RuntimeError("守护进程连接意外中断")
+
+    def forget_plan(self, query: str) -> bool:
+        self._replan = True
+        return True
+
+    def start_session(self) -> None:
+        """守护进程中的代理本就常驻内存，无需额外处理"""
+
+    def close(self) -> None:
+        pass
+
+    def plan_interaction(
+        self,
+        query: str,
+        on_explanation: Optional[Callable[[str, Optional[str]], None]] = None,
+        on_command: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[ActionPlan]:
+        request = {
+            "op": "plan",
+            "query": query,
+            "stream": bool(on_explanation),
+            "early": bool(on_command),
+            "replan": self._replan,
+            "trace": self.tracer.enabled,
+        }
+        self._replan = False
+
+        def on_event(message: Dict[str, Any]) -> None:
+            if message.get("event") == "command":
+                if on_command:
+                    on_command(message.get("command", ""))
+            elif on_explanation:
+                on_explanation(message.get("text", ""), message.get("intent"))
+
+        with self.tracer.span("daemon_plan") as span:
+            result = self._call(request, on_event)
+        self.tracer.merge(result.get("spans"), span)
+        self.first_token_latency = result.get("first_token_latency")
+        plan = result.get("plan")
+        return ActionPlan(**plan) if plan else None
+
+    def summarize_result(
+        self,
+        query: str,
+        plan: ActionPlan,
+        result: CommandResult,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> Optional[str]:
+        request = {
+            "op": "summarize",
+            "query": query,
+            "plan": asdict(plan),
+            "result": asdict(result),
+            "stream": bool(on_token),
+            "trace": self.tracer.enabled,
+        }
+        with self.tracer.span("daemon_summarize") as span:
+            response = self._call(request, lambda message: on_token(message.get("text", "")) if on_token else None)
+        self.tracer.merge(response.get("spans"), span)
+        self.first_token_latency = response.get("first_token_latency")
+        return response.get("summary")
+
+    def record_interaction(
+        self,
+        query: str,
+        command: str,
+        output: Optional[str],
+        usage: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        with self.tracer.span("history_write"):
+            self._call({"op": "record", "query": query, "command": command, "output": output, "usage": usage})
+
+    def is_dangerous_command(self, command: str) -> bool:
+        """纯本地计算，不必往返守护进程"""
+        return is_dangerous_command(command)
+
+    def execute_plan(self, plan: ActionPlan, echo: Optional[bool] = None) -> CommandResult:
+        from trae.agent import execute_steps
+
+        if not plan.steps:
+            return self.execute_command(plan.command, echo=echo, cache_ttl=plan.cache_ttl)
+        return execute_steps(self, plan, self.config["exec_concurrency"], echo)
+
+    def execute_command(
+        self,
+        command: str,
+        echo: Optional[bool] = None,
+        cache_ttl: Optional[int] = None,
+        soft_deadline: Optional[float] = None,
+    ) -> CommandResult:
+        """命令在客户端本地执行，保持调用者的工作目录、环境与终端"""
+        from trae.agent import create_result_cache, execute_cached
+
+        if self.result_cache is None:
+            self.result_cache = create_result_cache(self.config)
+        return execute_cached(self, command, echo, cache_ttl, soft_deadline)
+
+
+def _request(path: Path, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as reader:
+            for line in reader:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def connect(overrides: Dict[str, Any], socket_path: Optional[Path] = None) -> Optional[RemoteAgent]:
+    """连接正在运行的守护进程；不可用时返回 None，由调用方回退到进程内执行"""
+    path = Path(socket_path or default_socket_path())
+    if not path.exists():
+        return None
+    try:
+        info = None
+        for message in _request(path, {"op": "ping", "overrides": overrides}):
+            if message.get("event") == "result":
+                info = message.get("result")
+        if not info or not info.get("has_api_key"):
+            return None
+    except (OSError, ValueError):
+        return None
+    return RemoteAgent(path, overrides, info)
@@ -0,0 +1,802 @@
+"""
+命令执行器 - 在本地 shell 中运行命令并收集结果
+"""
+import atexit
+import mmap
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from trae.plan import PlanStep, validate_steps
+
+
+DEFAULT_CAPTURE_BYTES = 1024 * 1024
+DEFAULT_SPILL_BYTES = 64 * 1024
+DEFAULT_KILL_GRACE = 2.0
+DEFAULT_JOBS_DIR = os.path.join(os.path.expanduser("~"), ".trae", "jobs")
+
+# 进程退出时兜底删除尚未清理的溢出文件
+_SPILL_FILES: Set[str] = set()
+atexit.register(lambda: [_remove_spill(path) for path in list(_SPILL_FILES)])
+
+
+def _remove_spill(path: Optional[str]) -> None:
+    if not path:
+        return
+    _SPILL_FILES.discard(path)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+@dataclass
+class ResourceUsage:
+    """子进程（含其已回收的后代）的资源消耗，来自 os.wait4 的 rusage
+
+    max_rss_kb 为峰值常驻内存（Linux 上包含 fork 时继承自 trae 的部分，
+    约十几 MB 的底数）；read_blocks/write_blocks 为块设备读写次数（512 字节
+    为单位，页缓存命中不计入）。
+    """
+    wall: float
+    user: float = 0.0
+    system: float = 0.0
+    max_rss_kb: int = 0
+    read_blocks: int = 0
+    write_blocks: int = 0
+
+    @property
+    def cpu(self) -> float:
+        return self.user + self.system
+
+    @property
+    def io_blocks(self) -> int:
+        return self.read_blocks + self.write_blocks
+
+    @classmethod
+    def from_rusage(cls, wall: float, rusage: Any) -> "ResourceUsage":
+        return cls(
+            wall=round(wall, 3),
+            user=round(rusage.ru_utime, 3),
+            system=round(rusage.ru_stime, 3),
+            max_rss_kb=int(rusage.ru_maxrss),
+            read_blocks=int(rusage.ru_inblock),
+            write_blocks=int(rusage.ru_oublock),
+        )
+
+    @classmethod
+    def combine(cls, usages: Iterable[Optional["ResourceUsage"]], wall: float) -> Optional["ResourceUsage"]:
+        """合并多个步骤：CPU 与 I/O 求和，内存取峰值，wall 取整体耗时"""
+        usages = [usage for usage in usages if usage]
+        if not usages:
+            return None
+        return cls(
+            wall=round(wall, 3),
+            user=round(sum(usage.user for usage in usages), 3),
+            system=round(sum(usage.system for usage in usages), 3),
+            max_rss_kb=max(usage.max_rss_kb for usage in usages),
+            read_blocks=sum(usage.read_blocks for usage in usages),
+            write_blocks=sum(usage.write_blocks for usage in usages),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def describe(self) -> str:
+        return (
+            f"耗时 {self.wall:.2f}s，CPU {self.cpu:.2f}s（用户 {self.user:.2f}s / 系统 {self.system:.2f}s），"
+            f"峰值内存 {self.max_rss_kb / 1024:.1f} MB，块 I/O 读 {self.read_blocks} / 写 {self.write_blocks}"
+        )
+
+
+@dataclass
+class CommandResult:
+    """命令执行结果
+
+    stdout/stderr 只保留输出的开头与结尾（各约 capture_bytes/2），中间以
+    省略标记代替；*_bytes 记录真实输出的总字节数。streamed 表示输出已在
+    执行过程中交给 on_output 回调（通常是实时打印到终端），调用方无需再次显示。
+
+    捕获内容超过 spill_bytes 时写入临时文件（*_path），stdout/stderr 只是
+    其中的预览；需要摘录时用 excerpt() 通过 mmap 读取，用完调用 cleanup()。
+    cached_at 非空表示结果来自只读命令缓存，值为当初执行的时间戳；usage 为
+    本次执行的资源消耗（缓存结果与启动失败时为 None）。
+
+    timed_out 表示命令超时被终止，stdout/stderr 为终止前已产生的输出。
+    background_pid 非空表示命令在软截止时间后转入后台继续运行，此时
+    returncode 为 0、输出只是截至当时的部分，完整输出持续写入
+    job_log + ".out" / ".err"。
+    """
+    returncode: int
+    stdout: str
+    stderr: str
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    truncated: bool = False
+    streamed: bool = False
+    stdout_path: Optional[str] = None
+    stderr_path: Optional[str] = None
+    cached_at: Optional[float] = None
+    usage: Optional[ResourceUsage] = None
+    timed_out: bool = False
+    background_pid: Optional[int] = None
+    job_log: Optional[str] = None
+
+    def __post_init__(self) -> None:
+        # 经守护进程协议或结果缓存恢复时 usage 是字典
+        if isinstance(self.usage, dict):
+            self.usage = ResourceUsage(**self.usage)
+
+    def excerpt(self, stream: str = "stdout", limit: int = 2000) -> str:
+        """返回去掉首尾空白的输出，超过 2*limit 个字符时只保留首尾各 limit 个字符
+
+        只解码摘录所需的字节，不会把溢出文件整体读入内存。
+        """
+        path = getattr(self, f"{stream}_path")
+        if path:
+            try:
+                return _excerpt_file(path, limit)
+            except (OSError, ValueError):
+                pass
+        return _excerpt_text(getattr(self, stream), limit)
+
+    def cleanup(self) -> None:
+        """删除溢出到磁盘的临时文件"""
+        _remove_spill(self.stdout_path)
+        _remove_spill(self.stderr_path)
+        self.stdout_path = None
+        self.stderr_path = None
+
+
+_EXCERPT_GAP = "\n...\n"
+
+
+def _excerpt_text(text: str, limit: int) -> str:
+    if len(text) > 2 * limit + len(_EXCERPT_GAP):
+        text = f"{text[:limit]}{_EXCERPT_GAP}{text[-limit:]}"
+    return text.strip()
+
+
+def _excerpt_file(path: str, limit: int) -> str:
+    # 一个字符最多 4 个 UTF-8 字节，读取首尾各 4*limit 字节足以覆盖 limit 个字符
+    window = 4 * max(1, limit)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if size <= 2 * window:
+                return _excerpt_text(_decode(mm[:]), limit)
+            head = _decode(mm[:window])
+            tail = _decode(_skip_continuation(mm[size - window :]))
+    return _excerpt_text(f"{head}{_EXCERPT_GAP}{tail}", limit)
+
+
+def _skip_continuation(data: bytes) -> bytes:
+    """去掉开头被截断的 UTF-8 续字节"""
+    start = 0
+    while start < min(3, len(data)) and 0x80 <= data[start] < 0xC0:
+        start += 1
+    return data[start:]
+
+
+class OutputCapture:
+    """有界输出捕获：保留前 head 字节与最后 tail 字节，内存占用与输出大小无关
+
+    设置 spill_bytes 后，输出一旦超过该大小就改写到临时文件：文件前半段
+    保存开头，后半段作为环形缓冲保存结尾，内存中不再保留输出。
+    """
+
+    def __init__(
+        self,
+        limit: int = DEFAULT_CAPTURE_BYTES,
+        spill_bytes: int = 0,
+        spill_dir: Optional[str] = None,
+    ) -> None:
+        limit = max(2, int(limit))
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        # 阈值不小于捕获上限时溢出没有意义
+        self.spill_bytes = int(spill_bytes) if 0 < int(spill_bytes) < limit else 0
+        self.spill_dir = spill_dir
+        self.head = bytearray()
+        self._tail: Deque[bytes] = deque()
+        self._tail_size = 0
+        self.total = 0
+        self.head_size = 0
+        self.tail_written = 0
+        self._fd: Optional[int] = None
+        self._spill_path: Optional[str] = None
+
+    def feed(self, data: bytes) -> None:
+        self.total += len(data)
+        if self._fd is None and self.spill_bytes and self.total > self.spill_bytes:
+            self._spill()
+        room = self.head_limit - self.head_size
+        if room > 0:
+            self._write_head(data[:room])
+            data = data[room:]
+        if data:
+            self._write_tail(data)
+
+    def _write_head(self, data: bytes) -> None:
+        if self._fd is not None:
+            os.pwrite(self._fd, data, self.head_size)
+        else:
+            self.head += data
+        self.head_size += len(data)
+
+    def _write_tail(self, data: bytes) -> None:
+        if self._fd is None:
+            self.tail_written += len(data)
+            self._tail.append(data)
+            self._tail_size += len(data)
+            while self._tail_size - len(self._tail[0]) >= self.tail_limit:
+                self._tail_size -= len(self._tail.popleft())
+            return
+        if len(data) > self.tail_limit:
+            self.tail_written += len(data) - self.tail_limit
+            data = data[-self.tail_limit :]
+        pos = self.tail_written % self.tail_limit
+        first = data[: self.tail_limit - pos]
+        os.pwrite(self._fd, first, self.head_limit + pos)
+        if len(first) < len(data):
+            os.pwrite(self._fd, data[len(first) :], self.head_limit)
+        self.tail_written += len(data)
+
+    def _spill(self) -> None:
+        try:
+            fd, path = tempfile.mkstemp(prefix="trae-output-", dir=self.spill_dir)
+        except OSError:
+            self.spill_bytes = 0
+            return
+        _SPILL_FILES.add(path)
+        self._fd, self._spill_path = fd, path
+        head, chunks = bytes(self.head), list(self._tail)
+        self.head, self._tail, self._tail_size = bytearray(), deque(), 0
+        self.head_size = self.tail_written = 0
+        self._write_head(head)
+        for chunk in chunks:
+            self._write_tail(chunk)
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > self.head_limit + self.tail_limit
+
+    def _omission(self, omitted: int) -> bytes:
+        return f"\n...[省略 {omitted} 字节]...\n".encode("utf-8")
+
+    def text(self) -> str:
+        """返回捕获的文本（仅内存模式；溢出模式请读取 finish() 返回的文件）"""
+        tail = b"".join(self._tail)[-self.tail_limit :]
+        omitted = self.total - len(self.head) - len(tail)
+        if omitted <= 0:
+            return _decode(bytes(self.head) + tail)
+        # 尾部可能从多字节字符中间截断，跳过开头的续字节
+        trimmed = _skip_continuation(tail)
+        omitted += len(tail) - len(trimmed)
+        return _decode(bytes(self.head) + self._omission(omitted) + trimmed)
+
+    def finish(self) -> Optional[str]:
+        """结束捕获；溢出时把开头、省略标记与按顺序排列的结尾写成新文件并返回路径"""
+        if self._fd is None:
+            return None
+        fd, ring_path = self._fd, self._spill_path
+        self._fd = self._spill_path = None
+        kept = min(self.tail_written, self.tail_limit)
+        start = (self.tail_written - kept) % self.tail_limit
+        # 结尾在环形区中可能分成两段
+        first = (self.head_limit + start, self.head_limit + min(start + kept, self.tail_limit))
+        second = (self.head_limit, self.head_limit + max(0, start + kept - self.tail_limit))
+        path = None
+        try:
+            with open(fd, "r+b") as ring:
+                if kept == 0 or (start == 0 and self.total == self.head_size + kept):
+                    # 结尾没有回绕且没有省略，文件本身已经按顺序排列
+                    ring.truncate(self.head_size + kept)
+                    return ring_path
+                out_fd, path = tempfile.mkstemp(prefix="trae-output-", dir=self.spill_dir)
+                _SPILL_FILES.add(path)
+                with mmap.mmap(ring.fileno(), 0, access=mmap.ACCESS_READ) as mm, open(out_fd, "wb") as out:
+                    skip = len(mm[first[0] : first[0] + 3]) - len(_skip_continuation(mm[first[0] : first[0] + 3]))
+                    out.write(mm[: self.head_size])
+                    out.write(self._omission(self.total - self.head_size - kept + skip))
+                    for begin, end in ((first[0] + skip, first[1]), second):
+                        for offset in range(begin, end, 64 * 1024):
+                            out.write(mm[offset : min(offset + 64 * 1024, end)])
+        except (OSError, ValueError):
+            _remove_spill(path)
+            path = None
+        _remove_spill(ring_path)
+        return path
+
+
+def _preview_file(path: str, budget: int) -> bytes:
+    """溢出文件的预览：不超过约 budget 字节的开头与结尾"""
+    half = max(1, budget // 2)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 2 * half:
+            return f.read()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            tail = _skip_continuation(mm[size - half :])
+            omitted = size - half - len(tail)
+            return mm[:half] + f"\n...[省略 {omitted} 字节]...\n".encode("utf-8") + tail
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace").replace("\r\n", "\n")
+
+
+def echo_output(stream_name: str, data: bytes) -> None:
+    """将一段输出原样写到当前终端对应的流"""
+    target = sys.stdout if stream_name == "stdout" else sys.stderr
+    buffer = getattr(target, "buffer", None)
+    if buffer is not None:
+        target.flush()
+        buffer.write(data)
+        buffer.flush()
+    else:
+        target.write(_decode(data))
+        target.flush()
+
+
+class _StreamSink:
+    """读取线程与 run_command 之间的交接点
+
+    close() 之后到达的数据被丢弃、读取线程随即退出，因此 run_command 可以在
+    读取线程仍阻塞时安全地结束捕获（逃出进程组的子进程可能一直持有管道）。
+    """
+
+    def __init__(self, capture: OutputCapture, stream_name: str, on_output: Optional[Callable[[str, bytes], None]]) -> None:
+        self.capture = capture
+        self.stream_name = stream_name
+        self.on_output = on_output
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def feed(self, chunk: bytes) -> bool:
+        """写入一段输出；已关闭时返回 False"""
+        with self._lock:
+            if self._closed:
+                return False
+            self.capture.feed(chunk)
+            if self.on_output:
+                try:
+                    self.on_output(self.stream_name, chunk)
+                except (OSError, ValueError):
+                    self.on_output = None
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+
+
+def _pump(pipe: BinaryIO, sink: _StreamSink) -> None:
+    try:
+        while True:
+            chunk = pipe.read1(64 * 1024) if hasattr(pipe, "read1") else pipe.read(64 * 1024)
+            if not chunk or not sink.feed(chunk):
+                break
+    except (OSError, ValueError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _follow(path: str, sink: _StreamSink, stop: threading.Event) -> None:
+    """跟踪命令写入的日志文件，直到 stop 被设置且已读到文件末尾"""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                finished = stop.is_set()
+                chunk = f.read(64 * 1024)
+                if chunk:
+                    if not sink.feed(chunk):
+                        break
+                    continue
+                if finished:
+                    break
+                stop.wait(0.05)
+    except OSError:
+        pass
+
+
+def _signal_group(pgid: int, sig: int) -> bool:
+    """向进程组发送信号，进程组已不存在时返回 False"""
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 组内有提权运行的进程（如 sudo 启动的命令），组仍然存在
+        return True
+    return True
+
+
+def _terminate_group(process: subprocess.Popen, waiter: "_Waiter", grace: float) -> None:
+    """先向整个进程组发送 SIGTERM，grace 秒后仍有存活进程则发送 SIGKILL
+
+    shell 本身退出后，它启动的后台子进程、管道中的其他命令仍在同一进程组中，
+    因此以进程组是否存在为准，而不只是等待 shell。
+    """
+    _kill_group(process.pid, grace, waiter)
+    waiter.wait()
+
+
+def _kill_group(pgid: int, grace: float, waiter: Optional["_Waiter"] = None) -> None:
+    deadline = time.monotonic() + max(0.0, grace)
+    if _signal_group(pgid, signal.SIGTERM):
+        if waiter:
+            waiter.wait(grace)
+        while _signal_group(pgid, 0) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    _signal_group(pgid, signal.SIGKILL)
+
+
+# 已转入后台、仍受硬超时约束的命令：进程组 ID -> (截止时间戳, kill_grace, _Waiter)
+_DETACHED: Dict[int, Tuple[float, float, "_Waiter"]] = {}
+_DETACHED_LOCK = threading.Lock()
+
+
+def _watch_detached(process: subprocess.Popen, waiter: "_Waiter", deadline: float, grace: float) -> None:
+    """后台命令的看门狗：到达硬超时仍未结束则终止整个进程组"""
+    with _DETACHED_LOCK:
+        _DETACHED[process.pid] = (deadline, grace, waiter)
+    try:
+        if not waiter.wait(max(0.0, deadline - time.time())):
+            _terminate_group(process, waiter, grace)
+    finally:
+        with _DETACHED_LOCK:
+            _DETACHED.pop(process.pid, None)
+
+
+def watch_group(pgid: int, deadline: float, grace: float) -> None:
+    """独立看门狗进程的入口：进程组存活到 deadline 时先 SIGTERM 再 SIGKILL"""
+    while _signal_group(pgid, 0):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            _kill_group(pgid, grace)
+            return
+        time.sleep(min(1.0, remaining))
+
+
+@atexit.register
+def _handoff_watchdogs() -> None:
+    """trae 退出时后台命令仍在运行，改由独立进程继续执行硬超时"""
+    with _DETACHED_LOCK:
+        pending = [(pgid, deadline, grace) for pgid, (deadline, grace, waiter) in _DETACHED.items() if not waiter.wait(0)]
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")])))
+    for pgid, deadline, grace in pending:
+        try:
+            subprocess.Popen(
+                [sys.executable, "-c", "import sys; from trae.executor import watch_group; "
+                 "watch_group(int(sys.argv[1]), float(sys.argv[2]), float(sys.argv[3]))",
+                 str(pgid), repr(deadline), repr(grace)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                env=env,
+                start_new_session=True,
+            )
+        except OSError:
+            pass
+
+
+def _open_job_files(jobs_dir: str) -> str:
+    """在 jobs_dir 下创建一对日志文件，返回不含扩展名的路径"""
+    os.makedirs(jobs_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=time.strftime("%Y%m%d-%H%M%S-"), suffix=".out", dir=jobs_dir)
+    os.close(fd)
+    stem = path[: -len(".out")]
+    open(stem + ".err", "wb").close()
+    return stem
+
+
+def run_command(
+    command: str,
+    timeout: float = 30,
+    on_output: Optional[Callable[[str, bytes], None]] = None,
+    capture_bytes: int = DEFAULT_CAPTURE_BYTES,
+    spill_bytes: int = 0,
+    kill_grace: float = DEFAULT_KILL_GRACE,
+    soft_deadline: float = 0,
+    jobs_dir: Optional[str] = None,
+) -> CommandResult:
+    """
+    执行命令
+
+    命令在独立的会话与进程组中运行。超时后先向整个进程组发送 SIGTERM，
+    kill_grace 秒后仍未退出则发送 SIGKILL，shell 启动的子孙进程不会残留；
+    终止前已产生的输出保留在结果中。
+
+    Args:
+        command: 要执行的命令
+        timeout: 超时时间（秒）
+        on_output: 可选回调 (stream_name, chunk)，输出到达时立即调用，
+            例如传入 echo_output 实时打印到终端
+        capture_bytes: 每个流最多保留的字节数（开头与结尾各一半）
+        spill_bytes: 大于 0 时，捕获超过该大小即溢出到临时文件，内存只保留预览
+        kill_grace: 超时后从 SIGTERM 升级到 SIGKILL 之前等待的秒数
+        soft_deadline: 大于 0 且小于 timeout 时启用软截止：输出写入 jobs_dir
+            下的日志文件，命令运行超过该秒数即返回部分结果，命令转入后台继续运行
+        jobs_dir: 软截止模式的日志目录，默认 ~/.trae/jobs
+
+    Returns:
+        CommandResult 对象
+    """
+    detachable = 0 < soft_deadline and (timeout is None or soft_deadline < timeout)
+    job_log: Optional[str] = None
+    start = time.perf_counter()
+    try:
+        if detachable:
+            # 输出直接写入文件而不是管道，trae 退出后命令仍可继续写
+            job_log = _open_job_files(jobs_dir or DEFAULT_JOBS_DIR)
+            with open(job_log + ".out", "wb") as out, open(job_log + ".err", "wb") as err:
+                process = subprocess.Popen(
+                    command,
+                    shell=True,
+                    stdin=subprocess.DEVNULL,
+                    stdout=out,
+                    stderr=err,
+                    start_new_session=True,
+                )
+        else:
+            process = subprocess.Popen(
+                command,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+    except Exception as e:
+        _remove_job_files(job_log)
+        return CommandResult(
+            returncode=1,
+            stdout="",
+            stderr=f"执行错误: {e}"
+        )
+
+    stdout = OutputCapture(capture_bytes, spill_bytes)
+    stderr = OutputCapture(capture_bytes, spill_bytes)
+    stop = threading.Event()
+    sinks = [_StreamSink(stdout, "stdout", on_output), _StreamSink(stderr, "stderr", on_output)]
+    if job_log:
+        readers = [
+            threading.Thread(target=_follow, args=(job_log + suffix, sink, stop), daemon=True)
+            for suffix, sink in zip((".out", ".err"), sinks)
+        ]
+    else:
+        readers = [
+            threading.Thread(target=_pump, args=(pipe, sink), daemon=True)
+            for pipe, sink in zip((process.stdout, process.stderr), sinks)
+        ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = detached = False
+    waiter = _Waiter(process, start)
+    try:
+        if detachable and not waiter.wait(soft_deadline):
+            detached = True
+            # 转入后台后硬超时仍然有效
+            deadline = time.time() + timeout - soft_deadline if timeout is not None else None
+            if deadline is not None:
+                threading.Thread(
+                    target=_watch_detached,
+                    args=(process, waiter, deadline, kill_grace),
+                    name="trae-watchdog",
+                    daemon=True,
+                ).start()
+        elif not waiter.wait(timeout):
+            timed_out = True
+            _terminate_group(process, waiter, kill_grace)
+    except BaseException:
+        _signal_group(process.pid, signal.SIGKILL)
+        waiter.wait()
+        stop.set()
+        for sink in sinks:
+            sink.close()
+        raise
+    stop.set()
+    # 逃出进程组的子进程可能仍持有管道，超时后不无限等待读取线程；
+    # 关闭交接点后读取线程不再写入捕获，之后才能结束捕获
+    for reader in readers:
+        reader.join(timeout=1 if timed_out else None)
+    for sink in sinks:
+        sink.close()
+
+    stdout_path, stderr_path = stdout.finish(), stderr.finish()
+    stdout_text = stdout.text() if stdout_path is None else _decode(_preview_file(stdout_path, spill_bytes))
+    stderr_text = stderr.text() if stderr_path is None else _decode(_preview_file(stderr_path, spill_bytes))
+    returncode = waiter.returncode
+    if returncode is None and not detached:
+        returncode = 1
+        stderr_text = f"{stderr_text.rstrip()}\n执行错误: 无法获取退出状态: {waiter.error}".lstrip()
+    if timed_out:
+        returncode = 124
+        stderr_text = f"{stderr_text.rstrip()}\n命令执行超时".lstrip()
+    if detached:
+        returncode = 0
+    elif job_log:
+        # 命令在软截止前结束，输出已全部捕获，日志文件不再需要
+        _remove_job_files(job_log)
+        job_log = None
+    return CommandResult(
+        returncode=returncode,
+        stdout=stdout_text,
+        stderr=stderr_text,
+        stdout_bytes=stdout.total,
+        stderr_bytes=stderr.total,
+        truncated=stdout.truncated or stderr.truncated,
+        streamed=on_output is not None,
+        stdout_path=stdout_path,
+        stderr_path=stderr_path,
+        usage=None if detached else waiter.usage,
+        timed_out=timed_out,
+        background_pid=process.pid if detached else None,
+        job_log=job_log,
+    )
+
+
+def _remove_job_files(stem: Optional[str]) -> None:
+    if not stem:
+        return
+    for suffix in (".out", ".err"):
+        try:
+            os.unlink(stem + suffix)
+        except OSError:
+            pass
+
+
+class _Waiter:
+    """在后台线程中用 os.wait4 回收子进程，同时取得其 rusage
+
+    阻塞的 wait4 在子进程退出时立即返回，不像带超时的 Popen.wait 那样轮询。
+    回收后把退出码写回 Popen，避免其再次 waitpid。
+    """
+
+    def __init__(self, process: subprocess.Popen, start: float) -> None:
+        self.process = process
+        # 取不到退出状态时保持 None 并记录 error，由调用方报告为执行错误
+        self.returncode: Optional[int] = None
+        self.error: Optional[BaseException] = None
+        self.usage: Optional[ResourceUsage] = None
+        self._start = start
+        self._done = threading.Event()
+        threading.Thread(target=self._run, name="trae-wait4", daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            _, status, rusage = os.wait4(self.process.pid, 0)
+            self.usage = ResourceUsage.from_rusage(time.perf_counter() - self._start, rusage)
+            self.returncode = _exit_code(status)
+            self.process.returncode = self.returncode
+        except ChildProcessError:
+            self.returncode = self.process.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待子进程退出，超时返回 False"""
+        return self._done.wait(timeout)
+
+
+def _exit_code(status: int) -> int:
+    """把 wait 状态转换为 Popen 风格的退出码（被信号终止时为负的信号编号）
+
+    与 Python 3.9 起才有的 os.waitstatus_to_exitcode 等价。
+    """
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    raise ValueError(f"无法解析的进程状态: {status}")
+
+
+def run_plan_steps(
+    steps: List[PlanStep],
+    execute: Callable[[str], CommandResult],
+    max_workers: int = 4,
+    on_done: Optional[Callable[[PlanStep, CommandResult], None]] = None,
+) -> List[CommandResult]:
+    """按依赖关系执行多步骤规划，互不依赖的步骤在有界线程池中并发运行
+
+    依赖的步骤失败时，后续步骤不再执行。on_done 在调度线程中按完成顺序
+    调用，可用于逐个显示步骤结果而不会交错。返回值与 steps 顺序一致。
+    """
+    validate_steps(steps)
+    results: Dict[str, CommandResult] = {}
+    pending = {step.id: step for step in steps}
+    running: Dict[Future, str] = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="trae-step") as pool:
+        while pending or running:
+            for step_id, step in list(pending.items()):
+                if any(dep not in results for dep in step.depends_on):
+                    continue
+                del pending[step_id]
+                failed = [dep for dep in step.depends_on if results[dep].returncode != 0]
+                if failed:
+                    results[step_id] = CommandResult(
+                        returncode=1,
+                        stdout="",
+                        stderr=f"已跳过: 依赖的步骤 {', '.join(failed)} 执行失败",
+                    )
+                    if on_done:
+                        on_done(step, results[step_id])
+                    continue
+                running[pool.submit(execute, step.command)] = step_id
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step_id = running.pop(future)
+                try:
+                    results[step_id] = future.result()
+                except Exception as e:
+                    results[step_id] = CommandResult(returncode=1, stdout="", stderr=f"执行错误: {e}")
+                if on_done:
+                    on_done(next(step for step in steps if step.id == step_id), results[step_id])
+    return [results[step.id] for step in steps]
+
+
+def print_step_result(step: PlanStep, result: CommandResult) -> None:
+    """显示单个步骤的命令与输出"""
+    cached = "  （缓存结果）" if result.cached_at else ""
+    print(f"[{step.id}] $ {step.command}{cached}", flush=True)
+    if result.stdout:
+        echo_output("stdout", result.stdout.encode("utf-8"))
+    if result.stderr:
+        echo_output("stderr", result.stderr.encode("utf-8"))
+    if result.returncode != 0:
+        print(f"（退出码 {result.returncode}）")
+    print(flush=True)
+
+
+def merge_step_results(
+    steps: List[PlanStep],
+    results: List[CommandResult],
+    limit: int = 1600,
+    streamed: bool = False,
+    wall: float = 0.0,
+) -> CommandResult:
+    """把各步骤的结果合并成一个 CommandResult，每个步骤按比例分配摘录长度
+
+    wall 为整个规划的实际耗时；并行步骤的资源消耗按 ResourceUsage.combine 合并。
+    """
+    share = max(100, limit // (2 * max(1, len(steps))))
+    stdout_sections = []
+    stderr_sections = []
+    for step, result in zip(steps, results):
+        header = f"[{step.id}] $ {step.command} (退出码 {result.returncode})"
+        output = result.excerpt("stdout", share)
+        stdout_sections.append(f"{header}\n{output}" if output else header)
+        error = result.excerpt("stderr", share)
+        if error:
+            stderr_sections.append(f"[{step.id}] {error}")
+    return CommandResult(
+        returncode=next((result.returncode for result in results if result.returncode != 0), 0),
+        stdout="\n\n".join(stdout_sections),
+        stderr="\n".join(stderr_sections),
+        stdout_bytes=sum(result.stdout_bytes for result in results),
+        stderr_bytes=sum(result.stderr_bytes for result in results),
+        truncated=any(result.truncated for result in results),
+        streamed=streamed,
+        usage=ResourceUsage.combine((result.usage for result in results), wall),
+    )
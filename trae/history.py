@@ -3,22 +3,106 @@
 """
 from __future__ import annotations
 
+import contextlib
+import heapq
 import json
+import os
+import re
+import queue
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from trae.blobstore import BlobStore
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台不加锁
+    fcntl = None
+
+
+class HistoryEntry(dict):
+    """历史记录；较大的输出只保存 output_ref，首次访问 "output" 时才从 BlobStore 读取"""
+
+    _UNLOADED = object()
+
+    def __init__(self, data: Dict[str, Any], blobs: Optional[BlobStore] = None, output: Any = _UNLOADED) -> None:
+        super().__init__(data)
+        self._blobs = blobs
+        self._output = output
+
+    def _lazy_output(self) -> Optional[str]:
+        if self._output is self._UNLOADED:
+            ref = dict.get(self, "output_ref")
+            self._output = self._blobs.get(ref) if self._blobs and ref else None
+        return self._output
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "output" and not dict.__contains__(self, "output") and dict.__contains__(self, "output_ref"):
+            value = self._lazy_output()
+            if value is None:
+                raise KeyError(key)
+            return value
+        return super().__getitem__(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: object) -> bool:
+        if key == "output" and not dict.__contains__(self, "output") and dict.__contains__(self, "output_ref"):
+            return self._lazy_output() is not None
+        return super().__contains__(key)
 
 
 class ContextManager:
-    """简单的 JSONL 历史记录管理器"""
+    """JSONL 历史记录管理器
+
+    新记录以追加方式写入（O(1)），文件超过 compact_bytes 后做一次压缩：
+    只保留最近 max_entries 条写入临时文件，再通过 rename 原子替换。
+    fsync 取值 "always" 时每次追加都落盘，"never" 时交给操作系统刷写。
+
+    超过 blob_threshold 个字符的输出写入同目录下的 blobs/（按内容哈希去重、
+    zlib 压缩），记录中只保留 output_ref，读取时按需加载。每次压缩后回收
+    基础文件与所有分片都不再引用的 blob。
+
+    max_entries 只约束单个文件；每次压缩还会删除超过 shard_max_age 秒
+    未写入的其他分片（0 表示不删除），保留期内活跃的分片不受影响。
+
+    多个 trae 进程共用同一文件时，追加与压缩都持有旁路锁文件
+    （history.jsonl.lock）上的 flock 排他锁；每次追加都按路径重新打开，
+    因此不会写进已被压缩替换掉的旧文件。
+
+    解析结果缓存在内存中，以文件的 (mtime, size, inode) 校验：文件未被
+    其他进程改动时 load() 只需一次 stat，自己的追加与压缩直接更新缓存。
+    """
+
+    FSYNC_POLICIES = ("never", "always")
+    TAIL_BLOCK_SIZE = 64 * 1024
+    # 新于该秒数的 blob 不回收：引用它的记录可能正由其他进程追加
+    BLOB_SWEEP_MIN_AGE = 600
 
     def __init__(
         self,
         max_entries: int = 50,
         history_file: Optional[str] = None,
         output_limit: int = 2000,
+        fsync: str = "never",
+        compact_bytes: int = 1024 * 1024,
+        shard: Optional[str] = None,
+        blob_threshold: int = 512,
+        blob_root: Optional[str] = None,
+        shard_max_age: float = 30 * 86400,
     ) -> None:
         self.max_entries = max(1, int(max_entries))
         self.output_limit = max(200, int(output_limit))
+        self.fsync = fsync if fsync in self.FSYNC_POLICIES else "never"
+        self.compact_bytes = max(4096, int(compact_bytes))
+        self._compacted_size = 0
 
         if history_file:
             history_path = Path(history_file)
@@ -28,77 +112,661 @@ class ContextManager:
             base_dir = Path.home() / ".trae"
             base_dir.mkdir(parents=True, exist_ok=True)
             self.history_file = base_dir / "history.jsonl"
+        # 分片模式下每个终端/会话写各自的 history.<shard>.jsonl，检索时合并所有分片
+        self.base_file = self.history_file
+        if shard:
+            self.history_file = self.base_file.with_name(f"{self.base_file.stem}.{shard}{self.base_file.suffix}")
+        self.lock_file = self.history_file.with_name(f"{self.history_file.name}.lock")
+        self.shard_max_age = max(0.0, float(shard_max_age))
+        self.blob_threshold = max(0, int(blob_threshold))
+        self.blobs = BlobStore(blob_root or str(self.base_file.parent / "blobs"))
+
+        self._cache: Optional[Tuple[Tuple[int, ...], List[Dict[str, str]]]] = None
+
+        # 后台刷盘模式：历史常驻内存，写盘交给后台线程（交互式会话使用）
+        self._memory: Optional[List[Dict[str, str]]] = None
+        self._flush_queue: Optional["queue.Queue[Optional[Dict[str, str]]]"] = None
+        self._flush_thread: Optional[threading.Thread] = None
+
+    def start_background_flush(self) -> None:
+        """将历史载入内存，此后 load() 不再读盘，add_entry() 由后台线程写盘"""
+        if self._flush_thread is not None:
+            return
+        self._memory = self.load()
+        self._flush_queue = queue.Queue()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="trae-history-flush", daemon=True)
+        self._flush_thread.start()
+
+    def close(self) -> None:
+        """等待后台写盘完成"""
+        if self._flush_thread is None:
+            return
+        self._flush_queue.put(None)
+        self._flush_thread.join()
+        self._flush_thread = None
+        self._flush_queue = None
+        self._memory = None
+
+    def _flush_loop(self) -> None:
+        while True:
+            entry = self._flush_queue.get()
+            if entry is None:
+                return
+            # 合并积压的记录，一次追加写入
+            batch = [entry]
+            stop = False
+            while True:
+                try:
+                    pending = self._flush_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stop = True
+                    break
+                batch.append(pending)
+            self._append(batch)
+            if stop:
+                return
 
     def load(self) -> List[Dict[str, str]]:
         """读取最近的历史记录"""
-        entries: List[Dict[str, str]] = []
+        if self._memory is not None:
+            return list(self._memory)
+        try:
+            key = self._stat_key(os.stat(self.history_file))
+        except OSError:
+            self._cache = None
+            return []
+        cache = self._cache
+        if cache is not None and cache[0] == key:
+            return list(cache[1])
+        entries = self._read_file()
+        self._cache = (key, entries)
+        return list(entries)
 
-        if not self.history_file.exists():
-            return entries
+    def _stat_key(self, st: os.stat_result) -> Tuple[int, ...]:
+        return (st.st_mtime_ns, st.st_size, st.st_ino, self.max_entries)
+
+    def _read_file(self) -> List[Dict[str, str]]:
+        """从文件末尾按块反向读取，只解码最新的 max_entries 条有效记录"""
+        entries: List[Dict[str, str]] = []
+        limit = self.max_entries
 
         try:
-            with open(self.history_file, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line)
-                    except json.JSONDecodeError:
-                        continue
-
-                    if not isinstance(data, dict):
-                        continue
-
-                    query = data.get("query")
-                    command = data.get("command")
-                    output = data.get("output")
-
-                    if not isinstance(query, str) or not isinstance(command, str):
-                        continue
-
-                    entry: Dict[str, str] = {
-                        "query": query,
-                        "command": command,
-                    }
-                    if isinstance(output, str) and output:
-                        entry["output"] = output
-                    entries.append(entry)
+            with open(self.history_file, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                pos = f.tell()
+                remainder = b""
+                while pos > 0 and len(entries) < limit:
+                    size = min(self.TAIL_BLOCK_SIZE, pos)
+                    pos -= size
+                    f.seek(pos)
+                    lines = (f.read(size) + remainder).split(b"\n")
+                    # 块首行可能被截断，留到读取前一块时拼接
+                    remainder = lines.pop(0) if pos > 0 else b""
+                    for raw in reversed(lines):
+                        entry = self._parse_line(raw.decode("utf-8", errors="replace"))
+                        if entry is not None:
+                            entries.append(HistoryEntry(entry, self.blobs))
+                            if len(entries) >= limit:
+                                break
         except OSError:
             return []
 
-        return entries[-self.max_entries :]
+        entries.reverse()
+        return entries
+
+    @staticmethod
+    def _parse_line(line: str) -> Optional[Dict[str, str]]:
+        """解析单行 JSONL，无效记录返回 None"""
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+        if not isinstance(data, dict):
+            return None
+
+        query = data.get("query")
+        command = data.get("command")
+        output = data.get("output")
+        output_ref = data.get("output_ref")
+
+        if not isinstance(query, str) or not isinstance(command, str):
+            return None
 
-    def add_entry(self, query: str, command: str, output: Optional[str] = None) -> None:
-        """追加一条历史记录"""
         entry: Dict[str, str] = {
             "query": query,
             "command": command,
         }
-        if output:
-            entry["output"] = self._truncate(output)
+        if isinstance(output, str) and output:
+            entry["output"] = output
+        elif isinstance(output_ref, str) and output_ref:
+            entry["output_ref"] = output_ref
+        ts = data.get("ts")
+        if isinstance(ts, (int, float)):
+            entry["ts"] = ts
+        usage = data.get("usage")
+        if isinstance(usage, dict):
+            entry["usage"] = usage
+        return entry
 
-        entries = self.load()
-        entries.append(entry)
-        entries = entries[-self.max_entries :]
+    def add_entry(
+        self,
+        query: str,
+        command: str,
+        output: Optional[str] = None,
+        usage: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """追加一条历史记录；usage 为命令的资源消耗（见 ResourceUsage）"""
+        entry: Dict[str, Any] = {
+            "query": query,
+            "command": command,
+        }
+        if usage:
+            entry["usage"] = usage
+        text = self._truncate(output) if output else None
+        if text:
+            ref = self.blobs.put(text) if self.blob_threshold and len(text) > self.blob_threshold else None
+            if ref:
+                entry["output_ref"] = ref
+            else:
+                entry["output"] = text
+        entry["ts"] = round(time.time(), 3)
+        record = HistoryEntry(entry, self.blobs, text)
+
+        if self._memory is not None:
+            self._memory.append(record)
+            del self._memory[: -self.max_entries]
+            self._flush_queue.put(record)
+            return
+        self._append([record])
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        """持有跨进程排他锁
+
+        过期分片连同锁文件一起被删除时，等在旧锁上的进程取得的是已失效的
+        锁，因此加锁后确认路径仍指向同一文件，否则重新打开再加锁。
+        """
+        if fcntl is None:
+            yield
+            return
+        while True:
+            fd = os.open(str(self.lock_file), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(self.lock_file).st_ino == os.fstat(fd).st_ino
+                except FileNotFoundError:
+                    current = False
+            except BaseException:
+                os.close(fd)
+                raise
+            if current:
+                break
+            os.close(fd)
+        try:
+            yield
+        finally:
+            os.close(fd)
 
+    def _append(self, entries: List[Dict[str, str]]) -> None:
+        """以追加模式写入记录，必要时触发压缩"""
+        data = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in entries).encode("utf-8")
         try:
-            with open(self.history_file, "w", encoding="utf-8") as f:
+            with self._locked():
+                fd = os.open(str(self.history_file), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+                try:
+                    before = self._stat_key(os.fstat(fd))
+                    end = os.lseek(fd, 0, os.SEEK_END)
+                    # 上次写入若被中断留下半行，先补换行，避免新记录与之粘连
+                    if end and os.pread(fd, 1, end - 1) != b"\n":
+                        data = b"\n" + data
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                    if self.fsync == "always":
+                        os.fsync(fd)
+                    size = end + len(data)
+                    # 写入前缓存仍有效，说明期间没有其他进程改动，直接把新记录并入缓存
+                    cache = self._cache
+                    if cache is not None and cache[0] == before:
+                        self._cache = (self._stat_key(os.fstat(fd)), (cache[1] + entries)[-self.max_entries :])
+                    else:
+                        self._cache = None
+                finally:
+                    os.close(fd)
+                # 保留的记录本身可能超过阈值，此时放宽到上次压缩结果的两倍，避免每次追加都压缩
+                if size > max(self.compact_bytes, 2 * self._compacted_size):
+                    self._compact_locked()
+        except OSError:
+            return
+
+    def compact(self) -> None:
+        """只保留最近 max_entries 条记录，写临时文件后 rename 原子替换"""
+        try:
+            with self._locked():
+                self._compact_locked()
+        except OSError:
+            pass
+
+    def _compact_locked(self) -> None:
+        entries = self._read_file()
+        tmp_path = self.history_file.with_name(f"{self.history_file.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
                 for item in entries:
                     json.dump(item, f, ensure_ascii=False)
                     f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+                self._compacted_size = f.tell()
+            os.replace(tmp_path, self.history_file)
+            self._fsync_dir()
+            self._cache = (self._stat_key(os.stat(self.history_file)), entries)
+        except OSError:
+            self._cache = None
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            return
+        self._prune_shards()
+        self._sweep_blobs()
+
+    def _prune_shards(self) -> None:
+        """删除超过 shard_max_age 秒未写入的其他分片（基础文件与当前分片不删）"""
+        if not self.shard_max_age:
+            return
+        cutoff = time.time() - self.shard_max_age
+        for path in self._history_paths():
+            if path == self.base_file or path == self.history_file:
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    self._remove_shard(path, cutoff)
+            except OSError:
+                continue
+
+    @staticmethod
+    def _remove_shard(path: Path, cutoff: float) -> None:
+        """持有分片自己的锁时删除分片与锁文件
+
+        锁被占用说明仍有进程在写，跳过；取得锁后重新检查 mtime，期间有
+        新写入的分片保留。锁文件删除后，正等待旧锁的写入者会在 _locked()
+        中发现路径已指向别的文件并重新加锁，不会与新写入者同时持锁。
+        """
+        lock_path = path.with_name(f"{path.name}.lock")
+        if fcntl is None:
+            with contextlib.suppress(OSError):
+                path.unlink()
+            return
+        try:
+            fd = os.open(str(lock_path), os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.stat(lock_path).st_ino != os.fstat(fd).st_ino or path.stat().st_mtime >= cutoff:
+                return
+            path.unlink()
+            lock_path.unlink()
         except OSError:
             pass
+        finally:
+            os.close(fd)
+
+    def _sweep_blobs(self) -> None:
+        """删除基础文件与所有分片都不再引用的 blob
+
+        同一目录下的其他 JSONL 历史也共用 blobs/，它们引用的 blob 同样保留。
+        """
+        live = set()
+        paths = set(self._history_paths()) | set(self.base_file.parent.glob(f"*{self.base_file.suffix}"))
+        for path in sorted(paths):
+            try:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    for line in f:
+                        if '"output_ref"' not in line:
+                            continue
+                        entry = self._parse_line(line)
+                        if entry and "output_ref" in entry:
+                            live.add(entry["output_ref"])
+            except OSError:
+                # 读不到某个分片时无法确定哪些 blob 已失效，本次不回收
+                return
+        self.blobs.sweep(live, self.BLOB_SWEEP_MIN_AGE)
+
+    def _fsync_dir(self) -> None:
+        """rename 之后同步目录项，确保替换在崩溃后仍然可见"""
+        try:
+            fd = os.open(str(self.history_file.parent), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def search(self, terms: Sequence[str], limit: int = 20) -> List[Dict[str, str]]:
+        """在查询、命令与输出中查找同时包含所有关键词的记录，最新的在前
+
+        JSONL 后端只能顺序扫描，且仅覆盖压缩后保留的记录；分片模式下
+        扫描全部分片并按时间合并。
+        """
+        needles = [term.casefold() for term in terms if term.strip()]
+        matches = []
+        for entry in self._scan_all():
+            haystack = "\n".join((entry["query"], entry["command"], entry.get("output", ""))).casefold()
+            if all(needle in haystack for needle in needles):
+                matches.append((entry.get("ts", 0), len(matches), entry))
+        matches.sort(key=lambda item: item[:2], reverse=True)
+        return [entry for _, _, entry in matches[: max(1, int(limit))]]
+
+    def top_usage(self, sort: str = "cpu", limit: int = 20) -> List[Dict[str, Any]]:
+        """资源消耗最高的命令记录（所有分片中保留的记录）"""
+        return _top_usage(self._scan_all(), sort, limit)
+
+    def _scan_all(self) -> Iterator[HistoryEntry]:
+        """顺序读取基础文件与全部分片中的记录"""
+        for path in self._history_paths():
+            try:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    for line in f:
+                        entry = self._parse_line(line)
+                        if entry is not None:
+                            yield HistoryEntry(entry, self.blobs)
+            except OSError:
+                continue
+
+    def _history_paths(self) -> List[Path]:
+        """基础文件与全部分片文件"""
+        paths = [self.base_file] + sorted(self.base_file.parent.glob(f"{self.base_file.stem}.*{self.base_file.suffix}"))
+        return [path for path in paths if path.exists()]
 
     def _truncate(self, text: str) -> str:
         """限制输出长度，避免提示词过长"""
-        text = text.strip()
-        limit = self.output_limit
-        if len(text) <= limit:
-            return text
-        head = max(100, limit // 2)
-        tail = limit - head
-        head_text = text[:head].rstrip()
-        tail_text = text[-tail:].lstrip()
-        return f"{head_text}\n...\n{tail_text}"
+        return _truncate_output(text, self.output_limit)
+
+
+# trae stats 的排序键：记录的 usage 字典 -> 比较值
+USAGE_SORT_KEYS = {
+    "cpu": lambda usage: usage.get("user", 0) + usage.get("system", 0),
+    "wall": lambda usage: usage.get("wall", 0),
+    "rss": lambda usage: usage.get("max_rss_kb", 0),
+    "io": lambda usage: usage.get("read_blocks", 0) + usage.get("write_blocks", 0),
+}
+
+
+def _top_usage(entries: Iterable[Dict[str, Any]], sort: str, limit: int) -> List[Dict[str, Any]]:
+    key = USAGE_SORT_KEYS[sort]
+    with_usage = (entry for entry in entries if isinstance(entry.get("usage"), dict))
+    return heapq.nlargest(max(1, int(limit)), with_usage, key=lambda entry: key(entry["usage"]))
+
+
+def _truncate_output(text: str, limit: int) -> str:
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    head = max(100, limit // 2)
+    tail = limit - head
+    head_text = text[:head].rstrip()
+    tail_text = text[-tail:].lstrip()
+    return f"{head_text}\n...\n{tail_text}"
+
+
+class SqliteContextManager:
+    """SQLite 历史记录后端（WAL 模式）
+
+    与 ContextManager 保持相同的 load()/add_entry() 约定，但保留全部历史：
+    按时间与命令建索引，查询、命令与输出额外写入 FTS5 全文索引，用于
+    `trae history search`。FTS5 使用 trigram 分词以支持中文子串匹配；
+    SQLite 未编译 FTS5 或关键词短于 3 个字符时退回 LIKE 扫描。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 50,
+        db_path: Optional[str] = None,
+        output_limit: int = 2000,
+        import_from: Optional[str] = None,
+    ) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self.output_limit = max(200, int(output_limit))
+        self.db_path = Path(db_path) if db_path else Path.home() / ".trae" / "history.sqlite3"
+        self.import_from = Path(import_from) if import_from else None
+        self.fts_enabled = False
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_path), timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, "
+            "query TEXT NOT NULL, command TEXT NOT NULL, output TEXT)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        if "usage" not in columns:
+            conn.execute("ALTER TABLE history ADD COLUMN usage TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_ts ON history(ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_command ON history(command)")
+        try:
+            fts_columns = {row[1] for row in conn.execute("PRAGMA table_info(history_fts)")}
+            if fts_columns and "command" not in fts_columns:
+                # 旧版索引不含 command 列，重建后与 LIKE 回退、JSONL 后端的匹配范围一致
+                conn.execute("DROP TABLE history_fts")
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                "query, command, output, content='history', content_rowid='id', tokenize='trigram')"
+            )
+            if fts_columns and "command" not in fts_columns:
+                conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+            self.fts_enabled = True
+        except sqlite3.OperationalError:
+            self.fts_enabled = False
+        conn.commit()
+        self._conn = conn
+        (count,) = conn.execute("SELECT COUNT(*) FROM history").fetchone()
+        if count == 0 and self.import_from is not None:
+            self._import_jsonl(self.import_from)
+        return conn
+
+    def _import_jsonl(self, path: Path) -> None:
+        """首次使用时导入已有的 JSONL 历史"""
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                entries = [entry for entry in map(ContextManager._parse_line, f) if entry is not None]
+        except OSError:
+            return
+        blobs = BlobStore(str(path.parent / "blobs"))
+        now = time.time()
+        for entry in entries:
+            self._insert(entry.get("ts", now), HistoryEntry(entry, blobs))
+        self._conn.commit()
+
+    def _insert(self, ts: float, entry: Dict[str, str]) -> None:
+        usage = entry.get("usage")
+        cursor = self._conn.execute(
+            "INSERT INTO history (ts, query, command, output, usage) VALUES (?, ?, ?, ?, ?)",
+            (ts, entry["query"], entry["command"], entry.get("output"), json.dumps(usage) if usage else None),
+        )
+        if self.fts_enabled:
+            self._conn.execute(
+                "INSERT INTO history_fts (rowid, query, command, output) VALUES (?, ?, ?, ?)",
+                (cursor.lastrowid, entry["query"], entry["command"], entry.get("output") or ""),
+            )
+
+    def start_background_flush(self) -> None:
+        """SQLite 写入本身足够快，交互模式下无需后台线程"""
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def load(self) -> List[Dict[str, str]]:
+        """读取最近的历史记录"""
+        with self._lock:
+            try:
+                rows = self._connect().execute(
+                    "SELECT query, command, output FROM history ORDER BY id DESC LIMIT ?",
+                    (self.max_entries,),
+                ).fetchall()
+            except sqlite3.Error:
+                return []
+        return [self._row_entry(row) for row in reversed(rows)]
+
+    def add_entry(
+        self,
+        query: str,
+        command: str,
+        output: Optional[str] = None,
+        usage: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """追加一条历史记录"""
+        entry: Dict[str, Any] = {
+            "query": query,
+            "command": command,
+        }
+        if usage:
+            entry["usage"] = usage
+        if output:
+            entry["output"] = _truncate_output(output, self.output_limit)
+        with self._lock:
+            try:
+                self._connect()
+                self._insert(time.time(), entry)
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def search(self, terms: Sequence[str], limit: int = 20) -> List[Dict[str, Any]]:
+        """全文检索查询、命令与输出，返回最新的匹配记录（含时间戳 ts）"""
+        terms = [term.strip() for term in terms if term.strip()]
+        if not terms:
+            return []
+        limit = max(1, int(limit))
+        with self._lock:
+            try:
+                conn = self._connect()
+                if self.fts_enabled and all(len(term) >= 3 for term in terms):
+                    match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+                    rows = conn.execute(
+                        "SELECT h.query, h.command, h.output, h.ts FROM history_fts "
+                        "JOIN history h ON h.id = history_fts.rowid "
+                        "WHERE history_fts MATCH ? ORDER BY h.id DESC LIMIT ?",
+                        (match, limit),
+                    ).fetchall()
+                else:
+                    clauses = " AND ".join(
+                        "(query LIKE ? ESCAPE '\\' OR command LIKE ? ESCAPE '\\' OR output LIKE ? ESCAPE '\\')"
+                        for _ in terms
+                    )
+                    params: List[Any] = []
+                    for term in terms:
+                        pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                        params.extend([pattern] * 3)
+                    rows = conn.execute(
+                        f"SELECT query, command, output, ts FROM history WHERE {clauses} ORDER BY id DESC LIMIT ?",
+                        (*params, limit),
+                    ).fetchall()
+            except sqlite3.Error:
+                return []
+        results: List[Dict[str, Any]] = []
+        for row in rows:
+            entry: Dict[str, Any] = self._row_entry(row[:3])
+            entry["ts"] = row[3]
+            results.append(entry)
+        return results
+
+    def top_usage(self, sort: str = "cpu", limit: int = 20) -> List[Dict[str, Any]]:
+        """资源消耗最高的命令记录（含时间戳 ts 与 usage）"""
+        with self._lock:
+            try:
+                rows = self._connect().execute(
+                    "SELECT query, command, output, ts, usage FROM history WHERE usage IS NOT NULL"
+                ).fetchall()
+            except sqlite3.Error:
+                return []
+        entries = []
+        for row in rows:
+            try:
+                usage = json.loads(row[4])
+            except ValueError:
+                continue
+            entry: Dict[str, Any] = self._row_entry(row[:3])
+            entry.update(ts=row[3], usage=usage)
+            entries.append(entry)
+        return _top_usage(entries, sort, limit)
+
+    @staticmethod
+    def _row_entry(row: Sequence[Any]) -> Dict[str, str]:
+        query, command, output = row
+        entry = {"query": query, "command": command}
+        if output:
+            entry["output"] = output
+        return entry
+
+
+def shard_key(mode: Optional[str]) -> Optional[str]:
+    """history_shard 对应的分片名：tty 取终端设备名，session 取 TRAE_SESSION_ID 或会话 ID"""
+    key = None
+    if mode == "tty":
+        for fd in (0, 1, 2):
+            try:
+                key = os.ttyname(fd).replace("/dev/", "")
+                break
+            except OSError:
+                continue
+    elif mode == "session":
+        key = os.getenv("TRAE_SESSION_ID")
+        if not key:
+            try:
+                key = f"sid{os.getsid(0)}"
+            except (AttributeError, OSError):
+                key = None
+    if not key:
+        return None
+    return re.sub(r"[^A-Za-z0-9_-]+", "-", key).strip("-") or None
+
+
+def create_context_manager(config: Dict[str, Any], max_entries: Optional[int] = None, shard: Optional[str] = None):
+    """按 history_backend 配置创建历史记录管理器（jsonl 或 sqlite）
 
+    shard 为调用方已算好的分片名（守护进程使用客户端的终端/会话），
+    省略时按 history_shard 在当前进程中计算。
+    """
+    max_entries = max_entries or config.get("context_window", 50)
+    output_limit = config.get("context_output_limit", 2000)
+    history_path = config.get("context_history_path")
+    if config.get("history_backend") == "sqlite":
+        jsonl_path = Path(history_path) if history_path else Path.home() / ".trae" / "history.jsonl"
+        return SqliteContextManager(
+            max_entries=max_entries,
+            db_path=config.get("history_db_path"),
+            output_limit=output_limit,
+            import_from=str(jsonl_path) if jsonl_path.exists() else None,
+        )
+    return ContextManager(
+        max_entries=max_entries,
+        history_file=history_path,
+        output_limit=output_limit,
+        fsync=config.get("history_fsync", "never"),
+        compact_bytes=config.get("history_compact_bytes", 1024 * 1024),
+        shard=shard or shard_key(config.get("history_shard")),
+        blob_threshold=config.get("history_blob_threshold", 512),
+        shard_max_age=config.get("history_shard_max_age", 30 * 86400),
+    )
@@ -2,9 +2,76 @@
 LLM 客户端 - 支持多种 LLM 提供商
 """
 import os
-from typing import Dict, Any, Optional
+import json
+import queue
+import asyncio
+import threading
+import weakref
+from typing import Dict, Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
 import sys
 
+from trae.cache import ResponseCache
+
+
+# 进程级客户端池：同一提供商/密钥只构建一次 SDK 客户端或 HTTP 会话，
+# 复用底层连接，避免每次调用都重新握手
+_CLIENT_POOL: Dict[Tuple[Any, ...], Any] = {}
+_CLIENT_POOL_LOCK = threading.Lock()
+
+
+def get_pooled_client(key: Tuple[Any, ...], factory: Callable[[], Any]) -> Any:
+    """按 key 返回复用的客户端，不存在时调用 factory 构建"""
+    with _CLIENT_POOL_LOCK:
+        client = _CLIENT_POOL.get(key)
+        if client is None:
+            client = factory()
+            _CLIENT_POOL[key] = client
+        return client
+
+
+# 异步客户端绑定事件循环，按循环分别缓存；循环被回收后自动释放
+_ASYNC_CLIENT_POOL: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[Any, ...], Any]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_pooled_async_client(key: Tuple[Any, ...], factory: Callable[[], Any]) -> Any:
+    """按当前事件循环与 key 返回复用的异步客户端"""
+    loop = asyncio.get_running_loop()
+    with _CLIENT_POOL_LOCK:
+        clients = _ASYNC_CLIENT_POOL.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = factory()
+            clients[key] = client
+        return client
+
+
+def reset_client_pool() -> None:
+    """关闭并清空客户端池（主要用于测试与基准）"""
+    with _CLIENT_POOL_LOCK:
+        clients = list(_CLIENT_POOL.values())
+        _CLIENT_POOL.clear()
+        _ASYNC_CLIENT_POOL.clear()
+    for client in clients:
+        close = getattr(client, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception:
+                pass
+
+
+async def _aclose_quietly(stream: Any) -> None:
+    """关闭被取消的异步流，忽略关闭时的错误"""
+    close = getattr(stream, "aclose", None)
+    if close is None:
+        return
+    try:
+        await close()
+    except Exception:
+        pass
+
 
 class LLMClient:
     """LLM 客户端基类"""
@@ -15,10 +82,35 @@ class LLMClient:
         self.api_key = config.get("api_key")
         self.model = config.get("model", "gpt-3.5-turbo")
         self.provider = config.get("provider", "openai")
+        self.temperature = config.get("temperature", 0.3)
+        self.cache: Optional[ResponseCache] = None
+        if config.get("cache_enabled", True):
+            self.cache = ResponseCache(
+                path=config.get("cache_path"),
+                max_entries=config.get("cache_max_entries", 1000),
+                ttl=config.get("cache_ttl", 86400),
+            )
+        # 主提供商之后按顺序尝试的备用提供商；hedge_delay > 0 时启用对冲请求
+        self.hedge_delay = float(config.get("hedge_delay") or 0)
+        self.targets = [self] + [
+            LLMClient(self._fallback_config(entry))
+            for entry in config.get("fallback_providers") or []
+            if isinstance(entry, dict) and entry.get("provider")
+        ]
+
+    def _fallback_config(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """备用提供商继承主配置，仅覆盖自身字段；缓存由主客户端统一处理"""
+        merged = dict(self.config)
+        merged.update(entry)
+        merged["fallback_providers"] = []
+        merged["cache_enabled"] = False
+        if "model" not in entry:
+            merged.pop("model", None)
+        return merged
     
     def generate(self, prompt: str) -> str:
         """
-        生成响应
+        生成响应（命中本地缓存时不发起网络请求）
         
         Args:
             prompt: 提示词
@@ -26,6 +118,376 @@ class LLMClient:
         Returns:
             LLM 响应文本
         """
+        key = self._cache_key(prompt)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return cached
+        text = self._generate(prompt)
+        if key:
+            self.cache.put(key, text)
+        return text
+
+    def generate_stream(self, prompt: str) -> Iterator[str]:
+        """
+        流式生成响应（命中缓存时一次性返回完整文本）
+
+        Args:
+            prompt: 提示词
+
+        Yields:
+            按到达顺序返回的文本片段
+        """
+        key = self._cache_key(prompt)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return iter([cached])
+        stream = self._generate_stream(prompt)
+        if not key:
+            return stream
+        return self._cache_stream(key, stream)
+
+    async def agenerate(self, prompt: str) -> str:
+        """
+        异步生成响应，可在同一事件循环中并发发起多个请求
+
+        Args:
+            prompt: 提示词
+
+        Returns:
+            LLM 响应文本
+        """
+        key = self._cache_key(prompt)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            return cached
+        text = await self._agenerate(prompt)
+        if key:
+            self.cache.put(key, text)
+        return text
+
+    def agenerate_stream(self, prompt: str) -> AsyncIterator[str]:
+        """
+        异步流式生成响应
+
+        Args:
+            prompt: 提示词
+
+        Yields:
+            按到达顺序返回的文本片段
+        """
+        return self._acache_stream(prompt)
+
+    def _cache_key(self, prompt: str) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return ResponseCache.make_key(self.provider, self.model, self.temperature, prompt)
+
+    def _cache_stream(self, key: str, stream: Iterator[str]) -> Iterator[str]:
+        """透传流式片段，完整结束后写入缓存"""
+        parts = []
+        for chunk in stream:
+            parts.append(chunk)
+            yield chunk
+        text = "".join(parts).strip()
+        if text:
+            self.cache.put(key, text)
+
+    async def _acache_stream(self, prompt: str) -> AsyncIterator[str]:
+        key = self._cache_key(prompt)
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for chunk in self._agenerate_stream(prompt):
+            parts.append(chunk)
+            yield chunk
+        text = "".join(parts).strip()
+        if key and text:
+            self.cache.put(key, text)
+
+    def _generate(self, prompt: str) -> str:
+        """按配置的提供商列表请求：出错时故障转移，超出延迟预算时对冲"""
+        if len(self.targets) == 1:
+            return self._generate_single(prompt)
+        if self.hedge_delay > 0:
+            return self._generate_hedged(prompt)
+
+        errors = []
+        for target in self.targets:
+            try:
+                return target._generate_single(prompt)
+            except (Exception, SystemExit) as exc:
+                errors.append(exc)
+                self._report_failure(target, exc)
+        raise errors[-1]
+
+    def _generate_hedged(self, prompt: str) -> str:
+        """对冲请求：首个提供商超过 hedge_delay 未返回时并行请求下一个，采用最先成功的结果
+
+        落后的请求在守护线程中自然结束，不阻塞进程退出。
+        """
+        results: "queue.Queue[Tuple[LLMClient, Optional[str], Optional[BaseException]]]" = queue.Queue()
+        pending = list(self.targets)
+        launched = 0
+        finished = 0
+        errors = []
+
+        def run(target: "LLMClient") -> None:
+            try:
+                results.put((target, target._generate_single(prompt), None))
+            except BaseException as exc:
+                results.put((target, None, exc))
+
+        def launch() -> None:
+            nonlocal launched
+            threading.Thread(target=run, args=(pending.pop(0),), daemon=True).start()
+            launched += 1
+
+        launch()
+        while True:
+            try:
+                target, text, error = results.get(timeout=self.hedge_delay if pending else None)
+            except queue.Empty:
+                launch()
+                continue
+            finished += 1
+            if error is None:
+                return text
+            errors.append(error)
+            self._report_failure(target, error)
+            if pending:
+                launch()
+            elif finished == launched:
+                raise errors[-1]
+
+    def _generate_stream(self, prompt: str) -> Iterator[str]:
+        """流式请求的故障转移：在收到首个片段之前出错则切换到下一个提供商"""
+        if len(self.targets) == 1:
+            return self._generate_stream_single(prompt)
+        if self.hedge_delay > 0:
+            return self._hedged_stream(prompt)
+        return self._failover_stream(prompt)
+
+    def _hedged_stream(self, prompt: str) -> Iterator[str]:
+        """流式对冲：比较各提供商的首个片段
+
+        首个提供商超过 hedge_delay 仍未产出首个片段时并行请求下一个；最先
+        产出首个片段的流胜出，此后只转发它的片段，其余流被取消（各自线程
+        在下一个片段到达时关闭连接）。收到首个片段之后出错不再切换。
+        """
+        events: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+        pending = list(self.targets)
+        cancels: List[threading.Event] = []
+        errors = []
+
+        def run(index: int, target: "LLMClient", cancel: threading.Event) -> None:
+            try:
+                stream = iter(target._generate_stream_single(prompt))
+                try:
+                    for chunk in stream:
+                        if cancel.is_set():
+                            break
+                        events.put((index, "chunk", chunk))
+                finally:
+                    close = getattr(stream, "close", None)
+                    if close:
+                        close()
+                events.put((index, "end", None))
+            except BaseException as exc:
+                events.put((index, "error", exc))
+
+        def launch() -> None:
+            cancels.append(threading.Event())
+            threading.Thread(
+                target=run, args=(len(cancels) - 1, pending.pop(0), cancels[-1]), daemon=True
+            ).start()
+
+        launch()
+        running = 1
+        winner: Optional[int] = None
+        try:
+            while True:
+                try:
+                    index, kind, payload = events.get(
+                        timeout=self.hedge_delay if winner is None and pending else None
+                    )
+                except queue.Empty:
+                    launch()
+                    running += 1
+                    continue
+                if winner is None:
+                    if kind == "error":
+                        running -= 1
+                        errors.append(payload)
+                        self._report_failure(self.targets[index], payload)
+                        if pending:
+                            launch()
+                            running += 1
+                        elif running == 0:
+                            raise errors[-1]
+                        continue
+                    winner = index
+                    for other, cancel in enumerate(cancels):
+                        if other != winner:
+                            cancel.set()
+                if index != winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "end":
+                    return
+                else:
+                    raise payload
+        finally:
+            for cancel in cancels:
+                cancel.set()
+
+    def _failover_stream(self, prompt: str) -> Iterator[str]:
+        errors = []
+        for target in self.targets:
+            try:
+                stream = iter(target._generate_stream_single(prompt))
+                first = next(stream, None)
+            except (Exception, SystemExit) as exc:
+                errors.append(exc)
+                self._report_failure(target, exc)
+                continue
+            if first is not None:
+                yield first
+            yield from stream
+            return
+        raise errors[-1]
+
+    async def _agenerate(self, prompt: str) -> str:
+        """异步版本的故障转移与对冲"""
+        if len(self.targets) == 1:
+            return await self._agenerate_single(prompt)
+
+        pending = list(self.targets)
+        running: Dict["asyncio.Task[str]", LLMClient] = {}
+        errors = []
+
+        def launch() -> None:
+            target = pending.pop(0)
+            running[asyncio.ensure_future(target._agenerate_single(prompt))] = target
+
+        launch()
+        try:
+            while running:
+                hedge = self.hedge_delay > 0 and pending
+                done, _ = await asyncio.wait(
+                    list(running),
+                    timeout=self.hedge_delay if hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    launch()
+                    continue
+                for task in done:
+                    target = running.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+                    errors.append(error)
+                    self._report_failure(target, error)
+                if pending:
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+        raise errors[-1]
+
+    def _agenerate_stream(self, prompt: str) -> AsyncIterator[str]:
+        if len(self.targets) == 1:
+            return self._agenerate_stream_single(prompt)
+        if self.hedge_delay > 0:
+            return self._ahedged_stream(prompt)
+        return self._afailover_stream(prompt)
+
+    async def _ahedged_stream(self, prompt: str) -> AsyncIterator[str]:
+        """_hedged_stream 的异步版本：竞争首个片段，胜出后关闭其余流"""
+        pending = list(self.targets)
+        running: Dict["asyncio.Task[Tuple[bool, Any]]", Tuple[AsyncIterator[str], LLMClient]] = {}
+        errors = []
+
+        async def first_chunk(stream: AsyncIterator[str]) -> Tuple[bool, Any]:
+            try:
+                return True, await stream.__anext__()
+            except StopAsyncIteration:
+                return False, None
+
+        def launch() -> None:
+            target = pending.pop(0)
+            stream = target._agenerate_stream_single(prompt)
+            running[asyncio.ensure_future(first_chunk(stream))] = (stream, target)
+
+        winner: Optional[AsyncIterator[str]] = None
+        first: Tuple[bool, Any] = (False, None)
+        launch()
+        try:
+            while running and winner is None:
+                done, _ = await asyncio.wait(
+                    list(running),
+                    timeout=self.hedge_delay if pending else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    launch()
+                    continue
+                for task in done:
+                    stream, target = running.pop(task)
+                    error = task.exception()
+                    if error is None and winner is None:
+                        winner, first = stream, task.result()
+                        continue
+                    if error is not None:
+                        errors.append(error)
+                        self._report_failure(target, error)
+                    await _aclose_quietly(stream)
+                if winner is None and pending:
+                    launch()
+        finally:
+            # 先等被取消的首片段任务结束，异步生成器不再运行后才能关闭
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            for stream, _ in running.values():
+                await _aclose_quietly(stream)
+        if winner is None:
+            raise errors[-1]
+        has_chunk, chunk = first
+        if not has_chunk:
+            return
+        yield chunk
+        async for chunk in winner:
+            yield chunk
+
+    async def _afailover_stream(self, prompt: str) -> AsyncIterator[str]:
+        errors = []
+        for target in self.targets:
+            stream = target._agenerate_stream_single(prompt)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                return
+            except (Exception, SystemExit) as exc:
+                errors.append(exc)
+                self._report_failure(target, exc)
+                continue
+            yield first
+            async for chunk in stream:
+                yield chunk
+            return
+        raise errors[-1]
+
+    @staticmethod
+    def _report_failure(target: "LLMClient", error: BaseException) -> None:
+        if os.getenv("TRAE_DEBUG") == "1":
+            print(f"LLM 提供商 {target.provider}/{target.model} 调用失败: {error}", file=sys.stderr)
+
+    def _generate_single(self, prompt: str) -> str:
+        """按提供商分发同步请求"""
         if self.provider == "openai":
             return self._generate_openai(prompt)
         elif self.provider == "anthropic":
@@ -36,6 +498,45 @@ class LLMClient:
             return self._generate_local(prompt)
         else:
             raise ValueError(f"不支持的 LLM 提供商: {self.provider}")
+
+    def _generate_stream_single(self, prompt: str) -> Iterator[str]:
+        """按提供商分发流式请求"""
+        if self.provider == "openai":
+            return self._stream_openai(prompt)
+        elif self.provider == "anthropic":
+            return self._stream_anthropic(prompt)
+        elif self.provider == "qwen" or self.provider == "dashscope":
+            return self._stream_qwen(prompt)
+        elif self.provider == "local":
+            return self._stream_local(prompt)
+        else:
+            raise ValueError(f"不支持的 LLM 提供商: {self.provider}")
+
+    async def _agenerate_single(self, prompt: str) -> str:
+        """按提供商分发异步请求"""
+        if self.provider == "openai":
+            return await self._agenerate_openai(prompt)
+        elif self.provider == "anthropic":
+            return await self._agenerate_anthropic(prompt)
+        elif self.provider == "qwen" or self.provider == "dashscope":
+            return await self._agenerate_qwen(prompt)
+        elif self.provider == "local":
+            return await self._agenerate_local(prompt)
+        else:
+            raise ValueError(f"不支持的 LLM 提供商: {self.provider}")
+
+    def _agenerate_stream_single(self, prompt: str) -> AsyncIterator[str]:
+        """按提供商分发异步流式请求"""
+        if self.provider == "openai":
+            return self._astream_openai(prompt)
+        elif self.provider == "anthropic":
+            return self._astream_anthropic(prompt)
+        elif self.provider == "qwen" or self.provider == "dashscope":
+            return self._astream_qwen(prompt)
+        elif self.provider == "local":
+            return self._astream_local(prompt)
+        else:
+            raise ValueError(f"不支持的 LLM 提供商: {self.provider}")
     
     def _generate_openai(self, prompt: str) -> str:
         """使用 OpenAI API"""
@@ -48,7 +549,10 @@ class LLMClient:
         if not self.api_key:
             raise ValueError("未设置 OpenAI API 密钥")
         
-        client = openai.OpenAI(api_key=self.api_key)
+        client = get_pooled_client(
+            ("openai", self.api_key),
+            lambda: openai.OpenAI(api_key=self.api_key),
+        )
         
         response = client.chat.completions.create(
             model=self.model,
@@ -56,7 +560,7 @@ class LLMClient:
                 {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.3,
+            temperature=self.temperature,
             max_tokens=200
         )
         
@@ -73,12 +577,15 @@ class LLMClient:
         if not self.api_key:
             raise ValueError("未设置 Anthropic API 密钥")
         
-        client = Anthropic(api_key=self.api_key)
+        client = get_pooled_client(
+            ("anthropic", self.api_key),
+            lambda: Anthropic(api_key=self.api_key),
+        )
         
         response = client.messages.create(
             model=self.model,
             max_tokens=200,
-            temperature=0.3,
+            temperature=self.temperature,
             messages=[
                 {"role": "user", "content": prompt}
             ]
@@ -115,7 +622,7 @@ class LLMClient:
                 {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.3,
+            temperature=self.temperature,
             max_tokens=200
         )
         
@@ -136,7 +643,8 @@ class LLMClient:
         ollama_url = self.config.get("ollama_url", "http://localhost:11434/api/generate")
         model = self.config.get("model", "llama2")
         
-        response = requests.post(
+        session = get_pooled_client(("local",), requests.Session)
+        response = session.post(
             ollama_url,
             json={
                 "model": model,
@@ -160,6 +668,387 @@ class LLMClient:
             raise ValueError(f"Ollama 响应缺少 response 字段: {payload}")
         return str(text).strip()
 
+    def _stream_openai(self, prompt: str) -> Iterator[str]:
+        """OpenAI 流式输出"""
+        try:
+            import openai
+        except ImportError:
+            print("错误: 未安装 openai 库。请运行: pip install openai", file=sys.stderr)
+            sys.exit(1)
+
+        if not self.api_key:
+            raise ValueError("未设置 OpenAI API 密钥")
+
+        client = get_pooled_client(
+            ("openai", self.api_key),
+            lambda: openai.OpenAI(api_key=self.api_key),
+        )
+
+        stream = client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=200,
+            stream=True
+        )
+        for chunk in stream:
+            choices = getattr(chunk, "choices", None)
+            if not choices:
+                continue
+            delta = getattr(choices[0], "delta", None)
+            text = getattr(delta, "content", None)
+            if text:
+                yield text
+
+    def _stream_anthropic(self, prompt: str) -> Iterator[str]:
+        """Anthropic 流式输出"""
+        try:
+            from anthropic import Anthropic
+        except ImportError:
+            print("错误: 未安装 anthropic 库。请运行: pip install anthropic", file=sys.stderr)
+            sys.exit(1)
+
+        if not self.api_key:
+            raise ValueError("未设置 Anthropic API 密钥")
+
+        client = get_pooled_client(
+            ("anthropic", self.api_key),
+            lambda: Anthropic(api_key=self.api_key),
+        )
+
+        with client.messages.stream(
+            model=self.model,
+            max_tokens=200,
+            temperature=self.temperature,
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
+        ) as stream:
+            for text in stream.text_stream:
+                if text:
+                    yield text
+
+    def _stream_qwen(self, prompt: str) -> Iterator[str]:
+        """DashScope 流式输出（增量模式）"""
+        try:
+            import dashscope
+        except ImportError:
+            print("错误: 未安装 dashscope 库。请运行: pip install dashscope", file=sys.stderr)
+            sys.exit(1)
+
+        if not self.api_key:
+            raise ValueError("未设置 DashScope API 密钥")
+
+        dashscope.api_key = self.api_key
+        from dashscope import Generation
+
+        responses = Generation.call(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=200,
+            result_format="message",
+            stream=True,
+            incremental_output=True
+        )
+        for response in responses:
+            if response.status_code != 200:
+                raise Exception(f"DashScope API 错误: {response.status_code} - {response.message}")
+            output = getattr(response, "output", None)
+            choices = output.get("choices") if isinstance(output, dict) else getattr(output, "choices", None)
+            if not choices:
+                continue
+            first = choices[0]
+            message = first.get("message") if isinstance(first, dict) else getattr(first, "message", None)
+            if isinstance(message, dict):
+                text = message.get("content")
+            else:
+                text = getattr(message, "content", None)
+            if isinstance(text, str) and text:
+                yield text
+
+    def _stream_local(self, prompt: str) -> Iterator[str]:
+        """Ollama 流式输出（逐行 JSON）"""
+        try:
+            import requests
+        except ImportError:
+            print("错误: 未安装 requests 库。请运行: pip install requests", file=sys.stderr)
+            sys.exit(1)
+
+        ollama_url = self.config.get("ollama_url", "http://localhost:11434/api/generate")
+        model = self.config.get("model", "llama2")
+
+        session = get_pooled_client(("local",), requests.Session)
+        with session.post(
+            ollama_url,
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": True
+            },
+            timeout=30,
+            stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"Ollama API 错误: {response.status_code}")
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    payload = json.loads(line)
+                except ValueError as exc:
+                    raise ValueError(f"Ollama 流式响应无法解析 JSON: {exc}") from exc
+                if payload.get("error"):
+                    raise Exception(f"Ollama API 错误: {payload['error']}")
+                text = payload.get("response")
+                if text:
+                    yield str(text)
+                if payload.get("done"):
+                    break
+
+    def _async_openai_client(self) -> Any:
+        try:
+            import openai
+        except ImportError:
+            print("错误: 未安装 openai 库。请运行: pip install openai", file=sys.stderr)
+            sys.exit(1)
+
+        if not self.api_key:
+            raise ValueError("未设置 OpenAI API 密钥")
+
+        return get_pooled_async_client(
+            ("openai", self.api_key),
+            lambda: openai.AsyncOpenAI(api_key=self.api_key),
+        )
+
+    async def _agenerate_openai(self, prompt: str) -> str:
+        """使用 OpenAI 异步 API"""
+        client = self._async_openai_client()
+        response = await client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=200
+        )
+        return self._extract_text_from_choices(response, "OpenAI")
+
+    async def _astream_openai(self, prompt: str) -> AsyncIterator[str]:
+        """OpenAI 异步流式输出"""
+        client = self._async_openai_client()
+        stream = await client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=200,
+            stream=True
+        )
+        async for chunk in stream:
+            choices = getattr(chunk, "choices", None)
+            if not choices:
+                continue
+            delta = getattr(choices[0], "delta", None)
+            text = getattr(delta, "content", None)
+            if text:
+                yield text
+
+    def _async_anthropic_client(self) -> Any:
+        try:
+            from anthropic import AsyncAnthropic
+        except ImportError:
+            print("错误: 未安装 anthropic 库。请运行: pip install anthropic", file=sys.stderr)
+            sys.exit(1)
+
+        if not self.api_key:
+            raise ValueError("未设置 Anthropic API 密钥")
+
+        return get_pooled_async_client(
+            ("anthropic", self.api_key),
+            lambda: AsyncAnthropic(api_key=self.api_key),
+        )
+
+    async def _agenerate_anthropic(self, prompt: str) -> str:
+        """使用 Anthropic 异步 API"""
+        client = self._async_anthropic_client()
+        response = await client.messages.create(
+            model=self.model,
+            max_tokens=200,
+            temperature=self.temperature,
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
+        )
+        content_blocks = getattr(response, "content", None)
+        if not content_blocks:
+            raise ValueError("Anthropic 响应未返回内容，请确认模型与配额。")
+        text = self._extract_text_from_message(content_blocks[0])
+        if not text:
+            raise ValueError("Anthropic 响应缺少文本内容，请检查请求参数。")
+        return text
+
+    async def _astream_anthropic(self, prompt: str) -> AsyncIterator[str]:
+        """Anthropic 异步流式输出"""
+        client = self._async_anthropic_client()
+        async with client.messages.stream(
+            model=self.model,
+            max_tokens=200,
+            temperature=self.temperature,
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
+        ) as stream:
+            async for text in stream.text_stream:
+                if text:
+                    yield text
+
+    def _aio_generation(self) -> Any:
+        """返回 DashScope 的异步接口；旧版本 SDK 不提供时返回 None"""
+        try:
+            import dashscope
+        except ImportError:
+            print("错误: 未安装 dashscope 库。请运行: pip install dashscope", file=sys.stderr)
+            sys.exit(1)
+
+        if not self.api_key:
+            raise ValueError("未设置 DashScope API 密钥")
+
+        dashscope.api_key = self.api_key
+        return getattr(dashscope, "AioGeneration", None)
+
+    async def _agenerate_qwen(self, prompt: str) -> str:
+        """使用 DashScope 异步 API"""
+        aio_generation = self._aio_generation()
+        if aio_generation is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._generate_qwen, prompt)
+
+        response = await aio_generation.call(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=200
+        )
+        if response.status_code != 200:
+            raise Exception(f"DashScope API 错误: {response.status_code} - {response.message}")
+        return self._extract_text_from_choices(getattr(response, "output", None), "DashScope")
+
+    async def _astream_qwen(self, prompt: str) -> AsyncIterator[str]:
+        """DashScope 异步流式输出"""
+        aio_generation = self._aio_generation()
+        if aio_generation is None:
+            yield await self._agenerate_qwen(prompt)
+            return
+
+        responses = await aio_generation.call(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "你是一个 Linux 命令生成助手。只返回命令，不要其他解释。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=200,
+            result_format="message",
+            stream=True,
+            incremental_output=True
+        )
+        async for response in responses:
+            if response.status_code != 200:
+                raise Exception(f"DashScope API 错误: {response.status_code} - {response.message}")
+            output = getattr(response, "output", None)
+            choices = output.get("choices") if isinstance(output, dict) else getattr(output, "choices", None)
+            if not choices:
+                continue
+            first = choices[0]
+            message = first.get("message") if isinstance(first, dict) else getattr(first, "message", None)
+            if isinstance(message, dict):
+                text = message.get("content")
+            else:
+                text = getattr(message, "content", None)
+            if isinstance(text, str) and text:
+                yield text
+
+    def _async_http_client(self) -> Any:
+        try:
+            import httpx
+        except ImportError:
+            print("错误: 未安装 httpx 库。请运行: pip install httpx", file=sys.stderr)
+            sys.exit(1)
+
+        return get_pooled_async_client(("local",), lambda: httpx.AsyncClient(timeout=30))
+
+    async def _agenerate_local(self, prompt: str) -> str:
+        """使用本地模型的异步接口（Ollama）"""
+        client = self._async_http_client()
+        ollama_url = self.config.get("ollama_url", "http://localhost:11434/api/generate")
+        model = self.config.get("model", "llama2")
+
+        response = await client.post(
+            ollama_url,
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": False
+            }
+        )
+        if response.status_code != 200:
+            raise Exception(f"Ollama API 错误: {response.status_code}")
+
+        try:
+            payload = response.json()
+        except ValueError as exc:
+            raise ValueError(f"Ollama 响应无法解析 JSON: {exc}") from exc
+
+        text = payload.get("response") or payload.get("output")
+        if not text:
+            raise ValueError(f"Ollama 响应缺少 response 字段: {payload}")
+        return str(text).strip()
+
+    async def _astream_local(self, prompt: str) -> AsyncIterator[str]:
+        """Ollama 异步流式输出（逐行 JSON）"""
+        client = self._async_http_client()
+        ollama_url = self.config.get("ollama_url", "http://localhost:11434/api/generate")
+        model = self.config.get("model", "llama2")
+
+        async with client.stream(
+            "POST",
+            ollama_url,
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": True
+            }
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"Ollama API 错误: {response.status_code}")
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                try:
+                    payload = json.loads(line)
+                except ValueError as exc:
+                    raise ValueError(f"Ollama 流式响应无法解析 JSON: {exc}") from exc
+                if payload.get("error"):
+                    raise Exception(f"Ollama API 错误: {payload['error']}")
+                text = payload.get("response")
+                if text:
+                    yield str(text)
+                if payload.get("done"):
+                    break
+
     def _extract_text_from_choices(self, container: Any, provider: str) -> str:
         """通用解析：从包含 choices 的结构中提取文本"""
         choices = None
@@ -2,12 +2,90 @@
 """
 Trae 主程序 - 自然语言 Linux 命令执行工具
 """
+import os
 import sys
-import subprocess
 import argparse
-from typing import Optional
-from trae.agent import CommandAgent
-from trae.config import get_config
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from trae.tracing import NULL_TRACER, Tracer
+
+
+class _StreamPrinter:
+    """将流式 token 实时打印到终端，并在结束时报告首个 token 延迟"""
+
+    INTENT_LABELS = {"run_command": "行动规划: "}
+
+    def __init__(self, label: Optional[str] = None) -> None:
+        self.label = label
+        self.started = False
+        self.finished = False
+
+    def __call__(self, text: str, intent: Optional[str] = None) -> None:
+        if self.finished:
+            return
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return
+            label = self.label if self.label is not None else self.INTENT_LABELS.get(intent or "", "")
+            print(f"\n{label}", end="", flush=True)
+            self.started = True
+        print(text, end="", flush=True)
+
+    def finish(self, first_token_latency: Optional[float]) -> None:
+        if not self.started or self.finished:
+            return
+        self.finished = True
+        print()
+        if first_token_latency is not None:
+            print(f"（首个 token 延迟 {first_token_latency:.2f}s）")
+
+
+class _EarlyExecution:
+    """规划流中 command 字段一闭合就在后台线程开始执行
+
+    模型随后还会输出 needs_summary 等字段，这段时间与命令执行重叠。
+    危险命令不会提前执行，仍等规划完成后走确认流程。
+    """
+
+    def __init__(self, agent, explanation_printer: Optional[_StreamPrinter]) -> None:
+        self.agent = agent
+        self.explanation_printer = explanation_printer
+        self.command: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._result = None
+        self._error: Optional[BaseException] = None
+
+    @property
+    def started(self) -> bool:
+        return self._thread is not None
+
+    def __call__(self, command: str) -> bool:
+        if self.started or self.agent.is_dangerous_command(command):
+            return False
+        self.command = command
+        if self.explanation_printer:
+            self.explanation_printer.finish(self.agent.first_token_latency)
+        print(f"\n生成的命令: {command}")
+        print("\n执行中...\n")
+        self._thread = threading.Thread(target=self._run, name="trae-early-exec", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self) -> None:
+        try:
+            self._result = self.agent.execute_command(self.command)
+        except BaseException as e:
+            self._error = e
+
+    def result(self):
+        """等待提前开始的命令结束并返回 CommandResult"""
+        self._thread.join()
+        if self._error:
+            raise self._error
+        return self._result
 
 
 def main():
@@ -20,6 +98,10 @@ def main():
   trae 帮我查询内存使用情况
   trae 显示当前目录的文件列表
   trae 查找所有 .log 文件
+  trae -i                 进入交互模式，连续追问
+  trae history search 磁盘  检索历史记录
+  trae stats --sort io     列出资源消耗最高的命令
+  trae --batch checks.txt  批量处理查询，按顺序输出 JSONL 结果
         """
     )
     
@@ -62,110 +144,485 @@ def main():
         help="上下文条数（默认 50）"
     )
     
-    args = parser.parse_args()
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="跳过本地缓存，强制重新请求 LLM"
+    )
+    
+    parser.add_argument(
+        "--replan",
+        action="store_true",
+        help="丢弃该查询的规划缓存并重新规划"
+    )
+    
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="忽略只读命令的结果缓存，重新执行命令"
+    )
+    
+    parser.add_argument(
+        "--soft-deadline",
+        type=float,
+        metavar="SECONDS",
+        default=None,
+        help="命令运行超过该秒数即返回已有输出，命令转入后台继续运行（输出写入 ~/.trae/jobs）"
+    )
+    
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="关闭流式输出，等待 LLM 完整响应后再显示"
+    )
+    
+    parser.add_argument(
+        "-i", "--interactive",
+        action="store_true",
+        help="交互模式：在同一会话中连续提问，代理与历史常驻内存"
+    )
+    
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="批处理模式：从文件读取查询（每行一条，- 表示标准输入），按输入顺序输出 JSONL 结果"
+    )
+    
+    parser.add_argument(
+        "--llm-concurrency",
+        type=int,
+        default=None,
+        help="批处理时同时进行的 LLM 调用数（默认 4）"
+    )
+    
+    parser.add_argument(
+        "--exec-concurrency",
+        type=int,
+        default=None,
+        help="同时执行的命令数（批处理与多步骤规划，默认 4）"
+    )
+    
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="结束后在标准错误输出各阶段耗时（配置加载、历史、规划、执行、总结等）"
+    )
+    
+    parser.add_argument(
+        "--trace-file",
+        metavar="FILE",
+        help="将各阶段耗时以 JSONL 追加到该文件（每行一个 span）"
+    )
+    
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="以守护进程模式运行，常驻内存并通过 Unix 套接字服务后续 trae 调用"
+    )
+    
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="不连接守护进程，始终在当前进程内执行"
+    )
+    
+    args, extra = parser.parse_known_args()
+    if extra and args.query[:1] != ["stats"]:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    
+    if args.context_window is not None and args.context_window < 1:
+        print("错误: --context-window 必须大于等于 1", file=sys.stderr)
+        sys.exit(1)
+    if args.soft_deadline is not None and args.soft_deadline < 0:
+        print("错误: --soft-deadline 不能为负数", file=sys.stderr)
+        sys.exit(1)
+    for flag in ("llm_concurrency", "exec_concurrency"):
+        if getattr(args, flag) is not None and getattr(args, flag) < 1:
+            print(f"错误: --{flag.replace('_', '-')} 必须大于等于 1", file=sys.stderr)
+            sys.exit(1)
+    overrides = _cli_overrides(args)
+    
+    if args.daemon:
+        from trae.daemon import serve
+        sys.exit(serve(_load_config(overrides)))
+    
+    if args.batch:
+        sys.exit(run_batch_file(args, overrides))
     
     # 如果没有提供查询，显示帮助
-    if not args.query:
+    if not args.query and not args.interactive:
         parser.print_help()
         sys.exit(0)
     
+    if args.query[:2] == ["history", "search"]:
+        sys.exit(run_history_search(args.query[2:], overrides))
+    if args.query[:1] == ["stats"]:
+        sys.exit(run_stats(args.query[1:] + extra, overrides))
+    
     query = " ".join(args.query)
+    tracer = Tracer() if args.timings or args.trace_file else NULL_TRACER
     
-    # 获取配置
-    config = get_config()
-    if args.api_key:
-        config["api_key"] = args.api_key
-    if args.provider:
-        config["provider"] = args.provider
-    if args.model:
-        config["model"] = args.model
-    if args.context_window is not None:
-        if args.context_window < 1:
-            print("错误: --context-window 必须大于等于 1", file=sys.stderr)
-            sys.exit(1)
-        config["context_window"] = args.context_window
+    try:
+        agent = None
+        if not args.no_daemon and os.getenv("TRAE_NO_DAEMON") != "1":
+            with tracer.span("daemon_connect") as span:
+                from trae.daemon import connect
+                agent = connect(overrides)
+                span.set(connected=agent is not None)
+        if agent is None:
+            agent = _local_agent(overrides, tracer)
+        agent.tracer = tracer
+        if args.interactive:
+            sys.exit(run_repl(agent, args, query or None))
+        try:
+            code = run_query(agent, query, args)
+        finally:
+            _report_trace(tracer, args, query)
+        sys.exit(code)
+    except KeyboardInterrupt:
+        print("\n\n已取消", file=sys.stderr)
+        sys.exit(130)
+    except Exception as e:
+        print(f"错误: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _cli_overrides(args: argparse.Namespace) -> Dict[str, Any]:
+    """命令行参数对应的配置覆盖项"""
+    overrides: Dict[str, Any] = {
+        "api_key": args.api_key,
+        "provider": args.provider,
+        "model": args.model,
+        "context_window": args.context_window,
+    }
+    if args.no_stream:
+        overrides["stream"] = False
+    if args.no_cache:
+        overrides["cache_enabled"] = False
+    if args.fresh:
+        overrides["result_cache_fresh"] = True
+    if args.soft_deadline is not None:
+        overrides["command_soft_deadline"] = args.soft_deadline
+    if args.llm_concurrency is not None:
+        overrides["llm_concurrency"] = args.llm_concurrency
+    if args.exec_concurrency is not None:
+        overrides["exec_concurrency"] = args.exec_concurrency
+    return {key: value for key, value in overrides.items() if value is not None}
+
+
+def _load_config(overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """读取配置并应用覆盖项，缺少 API 密钥时退出"""
+    from trae.config import get_config
+    from trae.daemon import apply_overrides
+
+    config = apply_overrides(get_config(), overrides)
     
     # 检查 API 密钥
     if not config.get("api_key"):
         print("错误: 未设置 API 密钥。请通过 --api-key 参数或环境变量 TRAE_API_KEY 设置。", file=sys.stderr)
         print("提示: 支持的 LLM 提供商包括 OpenAI、Anthropic、Qwen、本地模型等。", file=sys.stderr)
         sys.exit(1)
-    
+    return config
+
+
+def _local_agent(overrides: Dict[str, Any], tracer: Tracer = NULL_TRACER):
+    """没有可用守护进程时，在当前进程内构建代理"""
+    with tracer.span("config_load"):
+        config = _load_config(overrides)
+    with tracer.span("agent_init"):
+        from trae.agent import CommandAgent
+
+        return CommandAgent(config)
+
+
+def _report_trace(tracer: Tracer, args: argparse.Namespace, query: str) -> None:
+    """按 --timings 打印阶段耗时，按 --trace-file 追加 JSONL"""
+    if not tracer.enabled:
+        return
+    if args.timings:
+        print(f"\n{tracer.format_breakdown()}", file=sys.stderr)
+    if args.trace_file:
+        try:
+            tracer.write_jsonl(args.trace_file, query=query)
+        except OSError as e:
+            print(f"警告: 无法写入追踪文件 {args.trace_file}: {e}", file=sys.stderr)
+
+
+def run_batch_file(args: argparse.Namespace, overrides: Dict[str, Any]) -> int:
+    """trae --batch FILE|-：批处理始终在当前进程内执行，以便并发调用 LLM"""
+    from trae.batch import read_queries, run_batch
+
+    try:
+        if args.batch == "-":
+            queries = read_queries(sys.stdin)
+        else:
+            with open(args.batch, "r", encoding="utf-8") as f:
+                queries = read_queries(f)
+    except OSError as e:
+        print(f"错误: 无法读取批处理文件: {e}", file=sys.stderr)
+        return 1
+    if args.query:
+        print("错误: --batch 模式下不能同时提供查询参数", file=sys.stderr)
+        return 1
+    agent = _local_agent(overrides)
+    try:
+        return run_batch(agent, queries, dry_run=args.dry_run)
+    finally:
+        agent.close()
+
+
+def run_history_search(terms, overrides: Dict[str, Any], limit: int = 20) -> int:
+    """trae history search <关键词>：检索历史记录，最新的在前"""
+    from trae.config import get_config
+    from trae.daemon import apply_overrides
+    from trae.history import create_context_manager
+
+    if not terms:
+        print("用法: trae history search <关键词>...", file=sys.stderr)
+        return 1
+    manager = create_context_manager(apply_overrides(get_config(), overrides))
+    try:
+        results = manager.search(terms, limit=limit)
+    finally:
+        manager.close()
+    if not results:
+        print("未找到匹配的历史记录")
+        return 1
+    for entry in results:
+        ts = entry.get("ts")
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) + "  " if ts else ""
+        print(f"{stamp}{entry['query']}")
+        print(f"  $ {entry['command']}")
+    return 0
+
+
+def run_repl(agent, args: argparse.Namespace, first_query: Optional[str] = None) -> int:
+    """交互模式：复用同一个代理处理多轮查询，历史在内存中维护、后台写盘"""
     try:
-        agent = CommandAgent(config)
-        print(f"理解中: {query}")
-        plan = agent.plan_interaction(query)
+        import readline  # noqa: F401  启用行编辑与上下键历史
+    except ImportError:
+        pass
+
+    agent.start_session()
+    turn_args = argparse.Namespace(**vars(args))
+    print("Trae 交互模式，输入 exit 或按 Ctrl-D 退出。")
+    try:
+        pending = first_query
+        while True:
+            if pending is None:
+                try:
+                    line = input("\ntrae> ").strip()
+                except EOFError:
+                    print()
+                    break
+                except KeyboardInterrupt:
+                    print()
+                    continue
+            else:
+                line, pending = pending, None
+            if not line:
+                continue
+            if line in ("exit", "quit"):
+                break
+            try:
+                run_query(agent, line, turn_args)
+            except KeyboardInterrupt:
+                print("\n已取消", file=sys.stderr)
+            except Exception as e:
+                print(f"错误: {e}", file=sys.stderr)
+            turn_args.replan = False
+            if agent.tracer.enabled:
+                # 每轮单独追踪；第一轮包含启动阶段
+                _report_trace(agent.tracer, args, line)
+                agent.tracer = Tracer()
+    finally:
+        agent.close()
+    return 0
+
 
+def run_query(agent, query: str, args: argparse.Namespace) -> int:
+    """处理一次查询并返回退出码
+
+    agent 可以是进程内的 CommandAgent，也可以是连接守护进程的 RemoteAgent。
+    """
+    stream = bool(agent.config.get("stream", True))
+    print(f"理解中: {query}")
+    if args.replan:
+        agent.forget_plan(query)
+    explanation_printer = _StreamPrinter() if stream else None
+    early = None
+    if stream and agent.config.get("early_execution", True) and not args.dry_run:
+        early = _EarlyExecution(agent, explanation_printer)
+    plan = agent.plan_interaction(query, on_explanation=explanation_printer, on_command=early)
+    if explanation_printer:
+        explanation_printer.finish(agent.first_token_latency)
+
+    if early and early.started:
+        # 命令已在规划流中开始执行，规划固定为这条命令
+        result = early.result()
         if not plan:
-            print("错误: 无法生成有效的行动计划", file=sys.stderr)
-            sys.exit(1)
+            from trae.plan import ActionPlan
+
+            plan = ActionPlan(intent="run_command", command=early.command, needs_summary=True)
+        try:
+            return _finish_command(agent, query, plan, result, stream)
+        finally:
+            result.cleanup()
 
-        if plan.intent == "chat_reply":
-            reply = plan.response or plan.explanation or "（无可用回复）"
+    if not plan:
+        print("错误: 无法生成有效的行动计划", file=sys.stderr)
+        return 1
+
+    streamed = bool(explanation_printer and explanation_printer.started)
+
+    if plan.intent == "chat_reply":
+        reply = plan.response or plan.explanation or "（无可用回复）"
+        if not (streamed and not plan.response):
             print(f"\n{reply}")
-            agent.record_interaction(query, "[chat]", reply)
-            return
+        agent.record_interaction(query, "[chat]", reply)
+        return 0
 
-        if plan.intent == "ask_clarification":
-            message = plan.explanation or "我需要更多信息才能继续。"
+    if plan.intent == "ask_clarification":
+        message = plan.explanation or "我需要更多信息才能继续。"
+        if not streamed:
             print(f"\n{message}")
-            agent.record_interaction(query, "[clarification]", message)
-            return
+        agent.record_interaction(query, "[clarification]", message)
+        return 0
 
-        if plan.intent != "run_command":
-            print(f"错误: 无法识别的意图 {plan.intent}", file=sys.stderr)
-            sys.exit(1)
+    if plan.intent != "run_command":
+        print(f"错误: 无法识别的意图 {plan.intent}", file=sys.stderr)
+        return 1
 
-        if not plan.command:
-            print("错误: 规划结果缺少命令", file=sys.stderr)
-            sys.exit(1)
+    if not plan.command:
+        print("错误: 规划结果缺少命令", file=sys.stderr)
+        return 1
 
-        if plan.explanation:
-            print(f"\n行动规划: {plan.explanation}")
+    if plan.explanation and not streamed:
+        print(f"\n行动规划: {plan.explanation}")
+    if plan.from_cache:
+        print("（命中规划缓存，使用 --replan 重新规划）")
 
+    if plan.steps:
+        print(f"\n生成的命令（{len(plan.steps)} 个步骤，互不依赖的步骤并行执行）:")
+        for step in plan.steps:
+            after = f"  （依赖 {', '.join(step.depends_on)}）" if step.depends_on else ""
+            print(f"  [{step.id}] {step.command}{after}")
+    else:
         print(f"\n生成的命令: {plan.command}")
 
-        if args.dry_run:
-            agent.record_interaction(query, plan.command, "[dry-run]")
-            print("\n[干运行模式 - 命令未执行]")
-            return
+    if args.dry_run:
+        agent.record_interaction(query, plan.command, "[dry-run]")
+        print("\n[干运行模式 - 命令未执行]")
+        return 0
 
-        if agent.is_dangerous_command(plan.command):
-            response = input("\n警告: 此命令可能具有危险性。是否继续执行? (y/N): ")
-            if response.lower() != 'y':
-                print("已取消执行")
-                sys.exit(0)
+    commands = [step.command for step in plan.steps] or [plan.command]
+    if any(agent.is_dangerous_command(command) for command in commands):
+        response = input("\n警告: 此命令可能具有危险性。是否继续执行? (y/N): ")
+        if response.lower() != 'y':
+            print("已取消执行")
+            return 0
 
-        print("\n执行中...\n")
-        result = agent.execute_command(plan.command)
+    print("\n执行中...\n")
+    result = agent.execute_plan(plan)
+    try:
+        return _finish_command(agent, query, plan, result, stream)
+    finally:
+        result.cleanup()
 
-        log_output = None
-        if result.returncode == 0:
-            if result.stdout:
+
+def run_stats(argv, overrides: Dict[str, Any]) -> int:
+    """trae stats [--sort cpu|wall|rss|io] [--limit N]：按资源消耗列出历史中最昂贵的命令"""
+    from trae.config import get_config
+    from trae.daemon import apply_overrides
+    from trae.history import USAGE_SORT_KEYS, create_context_manager
+
+    parser = argparse.ArgumentParser(prog="trae stats", description="列出资源消耗最高的命令")
+    parser.add_argument("--sort", choices=sorted(USAGE_SORT_KEYS), default="cpu", help="排序依据（默认 cpu）")
+    parser.add_argument("--limit", type=int, default=10, help="显示条数（默认 10）")
+    options = parser.parse_args(argv)
+
+    manager = create_context_manager(apply_overrides(get_config(), overrides))
+    try:
+        entries = manager.top_usage(options.sort, options.limit)
+    finally:
+        manager.close()
+    if not entries:
+        print("历史记录中还没有资源消耗数据")
+        return 1
+    # 中文表头每字占两列，宽度按显示列数折算
+    print(f"{'耗时':>6} {'CPU':>8} {'内存':>7} {'块I/O':>8}  命令")
+    for entry in entries:
+        usage = entry["usage"]
+        cpu = usage.get("user", 0) + usage.get("system", 0)
+        io = usage.get("read_blocks", 0) + usage.get("write_blocks", 0)
+        rss = f"{usage.get('max_rss_kb', 0) / 1024:.1f}M"
+        print(f"{usage.get('wall', 0):>7.2f}s {cpu:>7.2f}s {rss:>9} {io:>9}  {entry['command']}")
+        ts = entry.get("ts")
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) + "  " if ts else ""
+        print(f"{'':>37}  {stamp}{entry['query']}")
+    return 0
+
+
+def _format_age(seconds: float) -> str:
+    if seconds < 60:
+        return f"{int(seconds)} 秒"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} 分钟"
+    return f"{seconds / 3600:.1f} 小时"
+
+
+def _finish_command(agent, query: str, plan, result, stream: bool) -> int:
+    """显示结果、总结并记录历史；历史只保存输出的首尾摘录"""
+    output_limit = agent.config.get("context_output_limit", 2000)
+    log_output = None
+    usage = result.usage.to_dict() if result.usage else None
+    if result.cached_at:
+        print(f"（缓存结果，{_format_age(time.time() - result.cached_at)}前执行；使用 --fresh 重新执行）\n")
+    if result.background_pid:
+        if result.stdout and not result.streamed:
+            print(result.stdout)
+        note = f"[后台运行 PID {result.background_pid}，输出写入 {result.job_log}.out/.err]"
+        print(f"\n命令仍在后台运行（PID {result.background_pid}），完整输出见 {result.job_log}.out 与 .err")
+        partial = result.excerpt("stdout", output_limit)
+        agent.record_interaction(query, plan.command, f"{note}\n{partial}".strip(), usage)
+        return 0
+    if result.timed_out:
+        # 超时终止前的部分输出同样显示并写入历史
+        if result.stdout and not result.streamed:
+            print(result.stdout)
+        # stderr 末尾是执行器追加的超时标记，由下面的提示代替
+        stderr = result.stderr.rsplit("命令执行超时", 1)[0].rstrip()
+        if stderr and not result.streamed:
+            print(stderr, file=sys.stderr)
+        timeout = agent.config.get("command_timeout", 30)
+        print(f"\n命令执行超时（{timeout} 秒），已终止其进程组；以上为超时前的输出", file=sys.stderr)
+        log_output = "\n".join(filter(None, [result.excerpt("stdout", output_limit), result.excerpt("stderr", output_limit)]))
+        agent.record_interaction(query, plan.command, log_output or None, usage)
+        return result.returncode
+    if result.returncode == 0:
+        if result.stdout:
+            if not result.streamed:
                 print(result.stdout)
-                log_output = result.stdout
-        else:
-            if result.stderr:
-                print(result.stderr, file=sys.stderr)
-                log_output = result.stderr or result.stdout
-            agent.record_interaction(query, plan.command, log_output)
-            sys.exit(result.returncode)
-
-        summary = agent.summarize_result(query, plan, result)
-        if summary:
+            log_output = result.excerpt("stdout", output_limit)
+    else:
+        if result.stderr and not result.streamed:
+            print(result.stderr, file=sys.stderr)
+        log_output = result.excerpt("stderr", output_limit) or result.excerpt("stdout", output_limit) or None
+        agent.record_interaction(query, plan.command, log_output, usage)
+        return result.returncode
+
+    summary_printer = _StreamPrinter("总结: ") if stream else None
+    summary = agent.summarize_result(query, plan, result, on_token=summary_printer)
+    if summary_printer:
+        summary_printer.finish(agent.first_token_latency)
+    if summary:
+        if not (summary_printer and summary_printer.started):
             print(f"\n总结: {summary}")
-            log_output = f"{summary}\n\n{log_output}".strip() if log_output else summary
+        log_output = f"{summary}\n\n{log_output}".strip() if log_output else summary
 
-        agent.record_interaction(query, plan.command, log_output)
-            
-    except KeyboardInterrupt:
-        print("\n\n已取消", file=sys.stderr)
-        sys.exit(130)
-    except Exception as e:
-        print(f"错误: {e}", file=sys.stderr)
-        sys.exit(1)
+    agent.record_interaction(query, plan.command, log_output, usage)
+    return 0
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,58 @@
+"""
+行动规划数据结构
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class PlanStep:
+    """多步骤规划中的一个命令；depends_on 中的步骤成功后才会执行"""
+    id: str
+    command: str
+    depends_on: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ActionPlan:
+    """LLM 规划结果
+
+    steps 非空时为多步骤规划，command 仅是各步骤命令的汇总（用于显示、
+    缓存与历史记录），实际按依赖关系执行 steps。cache_ttl 非空时单命令
+    规划的执行结果按该秒数缓存（用于技能生成的只读探测脚本）。
+    """
+    intent: str
+    explanation: Optional[str] = None
+    command: Optional[str] = None
+    needs_summary: bool = False
+    response: Optional[str] = None
+    skill_origin: Optional[str] = None
+    from_cache: bool = False
+    steps: List[PlanStep] = field(default_factory=list)
+    cache_ttl: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        # 从缓存或守护进程协议恢复时 steps 是字典列表
+        self.steps = [PlanStep(**step) if isinstance(step, dict) else step for step in self.steps or []]
+
+
+def validate_steps(steps: List[PlanStep]) -> None:
+    """检查步骤 ID 唯一、依赖存在且无环，不满足时抛出 ValueError"""
+    ids = [step.id for step in steps]
+    if len(set(ids)) != len(ids):
+        raise ValueError("规划步骤 ID 重复")
+    known = set(ids)
+    for step in steps:
+        missing = [dep for dep in step.depends_on if dep not in known]
+        if missing:
+            raise ValueError(f"步骤 {step.id} 依赖不存在的步骤: {', '.join(missing)}")
+
+    remaining = {step.id: set(step.depends_on) for step in steps}
+    while remaining:
+        ready = [step_id for step_id, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"规划步骤存在循环依赖: {', '.join(sorted(remaining))}")
+        for step_id in ready:
+            del remaining[step_id]
+        for deps in remaining.values():
+            deps.difference_update(ready)
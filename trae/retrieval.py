@@ -0,0 +1,148 @@
+"""
+历史检索 - 基于 BM25 的增量词法索引，为 Planner 挑选相关上下文
+"""
+from __future__ import annotations
+
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9_./-]+|[\u2e80-\u9fff\uac00-\ud7af]+")
+_CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af]")
+
+
+def tokenize(text: str) -> List[str]:
+    """英文/数字按单词切分，中日韩文字按相邻二元组切分（单字成词时保留单字）"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    tokens: List[str] = []
+    for run in _TOKEN_PATTERN.findall(text):
+        if not _CJK_PATTERN.match(run):
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """可增量增删文档的 BM25 索引"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self._docs: Dict[Hashable, Counter] = {}
+        self._lengths: Dict[Hashable, int] = {}
+        self._df: Counter = Counter()
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, doc_id: Hashable) -> bool:
+        return doc_id in self._docs
+
+    def ids(self) -> List[Hashable]:
+        return list(self._docs)
+
+    def add(self, doc_id: Hashable, text: str) -> None:
+        if doc_id in self._docs:
+            self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        self._docs[doc_id] = terms
+        self._lengths[doc_id] = sum(terms.values())
+        self._total_length += self._lengths[doc_id]
+        self._df.update(terms.keys())
+
+    def remove(self, doc_id: Hashable) -> None:
+        terms = self._docs.pop(doc_id, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(doc_id)
+        self._df.subtract(terms.keys())
+        for term in terms:
+            if self._df[term] <= 0:
+                del self._df[term]
+
+    def search(self, query: str, limit: int = 5) -> List[Tuple[Hashable, float]]:
+        """返回得分最高的文档 (doc_id, score)，只包含得分大于 0 的结果"""
+        terms = set(tokenize(query))
+        if not terms or not self._docs:
+            return []
+        count = len(self._docs)
+        avg_length = self._total_length / count or 1.0
+        idf = {
+            term: math.log(1 + (count - self._df[term] + 0.5) / (self._df[term] + 0.5))
+            for term in terms
+            if term in self._df
+        }
+        scores: List[Tuple[Hashable, float]] = []
+        for doc_id, doc_terms in self._docs.items():
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / avg_length)
+            for term, weight in idf.items():
+                freq = doc_terms.get(term)
+                if freq:
+                    score += weight * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((doc_id, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:limit]
+
+
+class HistoryRetriever:
+    """在历史记录中挑选与当前查询最相关的 top_k 条，再加上最近 recent 轮
+
+    索引随 load() 的结果增量同步：只对新出现的记录分词，已淘汰的记录
+    从索引中移除。只索引查询与命令，不触发输出 blob 的加载。候选范围
+    即 load() 返回的最近记录，由 context_retrieval_window 控制，更早的
+    记录不参与排序。索引可被多个线程共用（守护进程并发处理规划请求），
+    select() 持锁进行。
+    """
+
+    def __init__(self, top_k: int = 5, recent: int = 3) -> None:
+        self.top_k = max(0, int(top_k))
+        self.recent = max(0, int(recent))
+        self.index = BM25Index()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(entry: Dict[str, str]) -> Hashable:
+        return (entry.get("ts"), entry.get("query"), entry.get("command"))
+
+    def _sync(self, history: Sequence[Dict[str, str]]) -> List[Hashable]:
+        keys = [self._key(entry) for entry in history]
+        live = set(keys)
+        for stale in [key for key in self.index.ids() if key not in live]:
+            self.index.remove(stale)
+        for key, entry in zip(keys, history):
+            if key not in self.index:
+                self.index.add(key, f"{entry.get('query', '')}\n{entry.get('command', '')}")
+        return keys
+
+    def select(self, query: str, history: Sequence[Dict[str, str]]) -> List[Dict[str, str]]:
+        """返回按时间顺序排列的上下文子集"""
+        with self._lock:
+            return self._select(query, history)
+
+    def _select(self, query: str, history: Sequence[Dict[str, str]]) -> List[Dict[str, str]]:
+        keys = self._sync(history)
+        if len(history) <= self.top_k + self.recent:
+            return list(history)
+        recent_start = len(history) - self.recent
+        positions: Dict[Hashable, List[int]] = {}
+        for position, key in enumerate(keys[:recent_start]):
+            positions.setdefault(key, []).append(position)
+        chosen = set(range(recent_start, len(history)))
+        relevant = 0
+        for key, _ in self.index.search(query, limit=len(self.index)):
+            if relevant >= self.top_k:
+                break
+            for position in positions.get(key, ()):
+                if relevant < self.top_k:
+                    chosen.add(position)
+                    relevant += 1
+        return [history[position] for position in sorted(chosen)]
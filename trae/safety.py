@@ -0,0 +1,260 @@
+"""
+命令安全分析 - 危险命令检测（预编译的组合正则加基于 shlex 的结构分析）与只读命令识别
+"""
+from __future__ import annotations
+
+import os
+import re
+import shlex
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+
+# 直接匹配命令原文的模式，合并成一个预编译正则一次扫描
+DANGEROUS_PATTERNS = [
+    r'\brm\s+-rf',
+    r'\bdd\s+if=',
+    r'\bmkfs\b',
+    r'\bfdisk\b',
+    r'\bchmod\s+[0-7]{3,4}',
+    r'\bchown\s+.*\s+/',
+    r'>\s*/dev/(?!(?:null|zero|stdout|stderr|tty)\b)',
+    r'\|\s*sh\s*$',
+    r'\|\s*bash\s*$',
+]
+
+_DANGEROUS_RE = re.compile("|".join(f"(?:{pattern})" for pattern in DANGEROUS_PATTERNS), re.IGNORECASE)
+
+# 结构分析只会因这些程序名、重定向目标或引号转义而报警；不含任何一项的命令无需分词
+_TRIGGER_RE = re.compile(r"""['"\\]|rm|dd|mkfs|fdisk|wipefs|chmod|chown|sh|eval|/dev/""", re.IGNORECASE)
+
+# 命令替换：`...` 与 $(...)，内容按独立命令行递归分析
+_SUBSTITUTION_RE = re.compile(r'`([^`]*)`|\$\(([^()]*)\)')
+
+_MODE_RE = re.compile(r"[0-7]{3,4}")
+_PUNCTUATION = frozenset("();<>|&")
+_SHELLS = frozenset(["sh", "bash", "zsh", "dash", "ksh", "ash"])
+_SAFE_DEVICES = frozenset(["/dev/null", "/dev/zero", "/dev/stdout", "/dev/stderr", "/dev/tty"])
+_DISK_TOOLS = frozenset(["fdisk", "sfdisk", "wipefs"])
+
+# 前缀命令：名称 -> (需要参数的选项, 选项之后要跳过的位置参数个数)
+_WRAPPERS = {
+    "sudo": (frozenset(["-u", "-g", "-h", "-p", "-C", "-D", "-r", "-t", "-U", "-T"]), 0),
+    "doas": (frozenset(["-u", "-C"]), 0),
+    "env": (frozenset(["-u", "-C", "-S"]), 0),
+    "nice": (frozenset(["-n"]), 0),
+    "ionice": (frozenset(["-c", "-n", "-p"]), 0),
+    "nohup": (frozenset(), 0),
+    "time": (frozenset(["-f", "-o"]), 0),
+    "command": (frozenset(), 0),
+    "builtin": (frozenset(), 0),
+    "exec": (frozenset(["-a"]), 0),
+    "stdbuf": (frozenset(["-i", "-o", "-e"]), 0),
+    "timeout": (frozenset(["-s", "-k"]), 1),
+    "chroot": (frozenset(["--userspec", "--groups"]), 1),
+    "xargs": (frozenset(["-I", "-n", "-P", "-L", "-d", "-s", "-E", "-a"]), 0),
+}
+
+_MAX_DEPTH = 4
+
+# 只读且输出长期稳定的命令及其结果缓存秒数（硬件、内核与发行版信息）
+READ_ONLY_TTL = {
+    "lscpu": 3600,
+    "lspci": 3600,
+    "lshw": 3600,
+    "lsmem": 3600,
+    "dmidecode": 3600,
+    "nproc": 3600,
+    "arch": 3600,
+    "uname": 3600,
+    "getconf": 3600,
+    "lsb_release": 3600,
+    "lsblk": 300,
+    "lsusb": 300,
+    "lsmod": 300,
+}
+
+# cat 这些文件等同于查询硬件或发行版信息；/proc 下的文件由内核实时生成
+# （如 cpuinfo 中的 cpu MHz 随时变化），只缓存几秒
+_STABLE_FILES = {
+    "/proc/cpuinfo": 5,
+    "/proc/version": 5,
+    "/etc/os-release": 3600,
+    "/etc/lsb-release": 3600,
+}
+
+# 单独的 &（后台执行），排除 &&、>&、&> 与 |&
+_BACKGROUND_RE = re.compile(r"(?<![&>|])&(?![&>])")
+
+# 管道中可以出现的纯过滤命令；值为会写文件或永不结束的选项
+_FILTERS = {
+    "grep": (), "egrep": (), "fgrep": (), "head": (), "wc": (), "cut": (), "tr": (),
+    "column": (), "uniq": (), "nl": (),
+    "sort": ("-o", "--output"),
+    "tail": ("-f", "-F", "--follow"),
+    "sed": ("-i", "--in-place"),
+}
+
+
+class SimpleCommand(NamedTuple):
+    """管道或命令列表中的一条简单命令"""
+    argv: Tuple[str, ...]
+    piped: bool
+    redirects: Tuple[str, ...]
+
+
+def is_dangerous_command(command: str) -> bool:
+    """检查命令是否危险：先用组合正则匹配原文，再分析命令结构识别变形写法"""
+    return _is_dangerous(command, 0)
+
+
+@lru_cache(maxsize=4096)
+def _is_dangerous(command: str, depth: int) -> bool:
+    if _DANGEROUS_RE.search(command):
+        return True
+    if depth >= _MAX_DEPTH or not _TRIGGER_RE.search(command):
+        return False
+    for match in _SUBSTITUTION_RE.finditer(command):
+        if _is_dangerous(match.group(1) or match.group(2) or "", depth + 1):
+            return True
+    for simple in split_commands(command):
+        if _is_dangerous_simple(simple, depth):
+            return True
+    return False
+
+
+@lru_cache(maxsize=4096)
+def split_commands(command: str) -> Tuple[SimpleCommand, ...]:
+    """按 |、;、&&、||、& 与子 shell 括号拆分命令行，并剥离 sudo/env 等前缀
+
+    引号与反斜杠按 POSIX shell 规则去除，因此 r'm'、\\rm 与 rm 得到相同的
+    参数列表。无法解析（如引号不配对）时退回按空白拆分。
+    """
+    lexer = shlex.shlex(command.replace("\n", " ; "), posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        tokens = command.split()
+
+    commands = []
+    argv: list = []
+    redirects: list = []
+    piped = False
+    pending_redirect = ""
+    for token in tokens:
+        if pending_redirect:
+            if ">" in pending_redirect:
+                redirects.append(token)
+            pending_redirect = ""
+        elif not _PUNCTUATION.issuperset(token):
+            argv.append(token)
+        elif ("<" in token or ">" in token) and "(" not in token:
+            pending_redirect = token
+        else:
+            # 分隔符（含 <( 进程替换的括号）结束当前简单命令
+            if argv:
+                commands.append(SimpleCommand(_strip_wrappers(argv), piped, tuple(redirects)))
+            argv, redirects = [], []
+            piped = token in ("|", "|&")
+    if argv:
+        commands.append(SimpleCommand(_strip_wrappers(argv), piped, tuple(redirects)))
+    return tuple(commands)
+
+
+def _strip_wrappers(argv: list) -> Tuple[str, ...]:
+    """去掉环境变量赋值和 sudo、env、nohup、timeout 等前缀，返回实际执行的命令"""
+    index = 0
+    while index < len(argv):
+        word = argv[index]
+        if "=" in word and not word.startswith("-") and word.split("=", 1)[0].isidentifier():
+            index += 1
+            continue
+        wrapper = _WRAPPERS.get(os.path.basename(word))
+        if not wrapper:
+            break
+        options_with_value, positional = wrapper
+        index += 1
+        while index < len(argv) and argv[index].startswith("-"):
+            option = argv[index]
+            index += 1
+            if option == "--":
+                break
+            if option in options_with_value:
+                index += 1
+        index += positional
+    return tuple(argv[index:])
+
+
+def _is_dangerous_simple(simple: SimpleCommand, depth: int) -> bool:
+    for target in simple.redirects:
+        if target.startswith("/dev/") and target not in _SAFE_DEVICES:
+            return True
+    if not simple.argv:
+        return False
+    name = os.path.basename(simple.argv[0]).lower()
+    args = simple.argv[1:]
+
+    if name in _SHELLS or name == "eval":
+        script = _shell_script(args) if name != "eval" else " ".join(args)
+        if script is not None:
+            return _is_dangerous(script, depth + 1)
+        # 从管道读取脚本，相当于 curl ... | sh
+        return simple.piped
+    if name == "rm":
+        short = "".join(arg[1:] for arg in args if arg.startswith("-") and not arg.startswith("--"))
+        recursive = "r" in short or "R" in short or "--recursive" in args
+        force = "f" in short or "--force" in args
+        return recursive and force
+    if name == "dd":
+        return any(arg.startswith("if=") or arg.startswith("of=/dev/") for arg in args)
+    if name.startswith("mkfs") or name in _DISK_TOOLS:
+        return True
+    if name == "chmod":
+        return any(_MODE_RE.fullmatch(arg) for arg in args)
+    if name == "chown":
+        positional = [arg for arg in args if not arg.startswith("-")]
+        return any(arg.startswith("/") for arg in positional[1:])
+    return False
+
+
+def _shell_script(args: Tuple[str, ...]) -> Optional[str]:
+    """返回 sh -c 的脚本参数；没有 -c 时返回 None"""
+    for index, arg in enumerate(args):
+        if arg.startswith("-") and not arg.startswith("--") and "c" in arg:
+            return args[index + 1] if index + 1 < len(args) else ""
+        if not arg.startswith("-"):
+            return None
+    return None
+
+
+@lru_cache(maxsize=1024)
+def read_only_ttl(command: str) -> Optional[int]:
+    """命令只读且输出稳定时返回可缓存的秒数，否则返回 None
+
+    每个简单命令都必须在白名单中：数据来源取 READ_ONLY_TTL（管道取最小
+    值），其余只能是 grep、sort 等过滤命令；不允许命令替换、后台执行以及
+    重定向到文件。
+    """
+    if _SUBSTITUTION_RE.search(command) or _BACKGROUND_RE.search(command):
+        return None
+    ttl: Optional[int] = None
+    for simple in split_commands(command):
+        if not simple.argv or any(target not in _SAFE_DEVICES and not target.isdigit() for target in simple.redirects):
+            return None
+        name = os.path.basename(simple.argv[0])
+        args = simple.argv[1:]
+        if name in _FILTERS:
+            if name == "uniq" and len([arg for arg in args if not arg.startswith("-")]) > 1:
+                return None
+            if any(arg.startswith(option) for arg in args for option in _FILTERS[name]):
+                return None
+            continue
+        if name == "cat" and args and all(arg in _STABLE_FILES for arg in args):
+            seconds = min(_STABLE_FILES[arg] for arg in args)
+        elif name in READ_ONLY_TTL:
+            seconds = READ_ONLY_TTL[name]
+        else:
+            return None
+        ttl = seconds if ttl is None else min(ttl, seconds)
+    return ttl
@@ -7,6 +7,8 @@ from dataclasses import dataclass
 from typing import Iterable, List, Optional, Sequence
 import re
 
+from trae.safety import READ_ONLY_TTL
+
 
 @dataclass
 class SkillResult:
@@ -17,6 +19,7 @@ class SkillResult:
     response: Optional[str] = None
     explanation: Optional[str] = None
     needs_summary: bool = False
+    cache_ttl: Optional[int] = None  # 只读命令的结果缓存秒数
 
 
 @dataclass
@@ -122,6 +125,8 @@ PY"""
             command=command,
             explanation="我会收集 CPU/内存/GPU 等硬件信息并展示磁盘概况。",
             needs_summary=True,
+            # 输出包含 lsblk 的磁盘与挂载信息，按 lsblk 的缓存时间
+            cache_ttl=READ_ONLY_TTL["lsblk"],
         )
 
 
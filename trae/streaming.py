@@ -0,0 +1,227 @@
+"""
+流式输出辅助 - 在 LLM 输出尚未结束时增量解析 JSON 规划
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Callable, Dict, Optional
+
+
+class JsonObjectStreamParser:
+    """增量解析流式输出中的顶层 JSON 对象
+
+    LLM 的输出逐段 feed() 进来；对象之前的代码块标记或说明文字会被跳过。
+    顶层字符串值在到达时通过 on_string(key, text) 逐段回调已解码的文本，
+    任一顶层字段的值完整后立即通过 on_field(key, value) 回调，不必等待
+    整个对象结束。嵌套的对象与数组在闭合后整体用 json.loads 解码。
+    """
+
+    def __init__(
+        self,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        on_string: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        self.on_field = on_field
+        self.on_string = on_string
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._buffer = ""
+        self._pos = 0
+        self._state = "seek"
+        self._key: Optional[str] = None
+        self._value_start = 0
+        self._decode_pos = 0
+        self._depth = 0
+        self._in_string = False
+
+    def feed(self, chunk: str) -> None:
+        """输入一段新文本；结构不合法时抛出 json.JSONDecodeError"""
+        if self.done or not chunk:
+            return
+        self._buffer += chunk
+        while not self.done and self._step():
+            pass
+
+    def _error(self, message: str) -> json.JSONDecodeError:
+        return json.JSONDecodeError(message, self._buffer, self._pos)
+
+    def _skip_space(self) -> bool:
+        """跳过空白，返回是否还有待处理的字符"""
+        buffer = self._buffer
+        while self._pos < len(buffer) and buffer[self._pos] in " \t\r\n":
+            self._pos += 1
+        return self._pos < len(buffer)
+
+    def _step(self) -> bool:
+        """推进一个状态；输入不足以继续时返回 False"""
+        state = self._state
+        if state == "seek":
+            index = self._buffer.find("{", self._pos)
+            if index < 0:
+                self._pos = len(self._buffer)
+                return False
+            self._pos = index + 1
+            self._state = "key"
+            return True
+        if state in ("string", "key_string"):
+            return self._scan_string()
+        if state == "composite":
+            return self._scan_composite()
+        if state == "literal":
+            return self._scan_literal()
+        if not self._skip_space():
+            return False
+        char = self._buffer[self._pos]
+        if state == "key":
+            if char == "}" and not self.fields:
+                return self._finish()
+            if char != '"':
+                raise self._error("应为字段名")
+            self._begin_string("key_string")
+        elif state == "colon":
+            if char != ":":
+                raise self._error("应为 ':'")
+            self._pos += 1
+            self._state = "value"
+        elif state == "value":
+            if char == '"':
+                self._begin_string("string")
+            elif char in "{[":
+                self._value_start = self._pos
+                self._pos += 1
+                self._depth = 1
+                self._in_string = False
+                self._state = "composite"
+            else:
+                self._value_start = self._pos
+                self._state = "literal"
+        elif state == "after_value":
+            self._pos += 1
+            if char == ",":
+                self._state = "key"
+            elif char == "}":
+                return self._finish()
+            else:
+                raise self._error("应为 ',' 或 '}'")
+        return True
+
+    def _finish(self) -> bool:
+        self._pos += 1
+        self.done = True
+        return False
+
+    def _begin_string(self, state: str) -> None:
+        self._value_start = self._pos
+        self._pos += 1
+        self._decode_pos = self._pos
+        self._state = state
+
+    def _scan_string(self) -> bool:
+        """扫描字符串直到闭合引号；值字符串边扫描边回调解码出的片段"""
+        buffer = self._buffer
+        pos = self._pos
+        emit = self._state == "string" and self.on_string is not None
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                break
+            if char != "\\":
+                pos += 1
+                continue
+            # 转义序列跨片段时等待后续输入
+            if pos + 1 >= len(buffer):
+                break
+            if buffer[pos + 1] != "u":
+                pos += 2
+            elif pos + 6 > len(buffer):
+                break
+            elif "d800" <= buffer[pos + 2:pos + 6].lower() <= "dbff":
+                # UTF-16 代理对需要整体解码
+                if pos + 12 > len(buffer):
+                    break
+                pos += 12 if buffer[pos + 6:pos + 8] == "\\u" else 6
+            else:
+                pos += 6
+        if emit and pos > self._decode_pos:
+            text = _decode_fragment(buffer[self._decode_pos:pos])
+            if text:
+                self.on_string(self._key, text)
+            self._decode_pos = pos
+        self._pos = pos
+        if pos >= len(buffer) or buffer[pos] != '"':
+            return False
+        self._pos = pos + 1
+        value = json.loads(buffer[self._value_start:self._pos])
+        if self._state == "key_string":
+            self._key = value
+            self._state = "colon"
+        else:
+            self._complete(value)
+        return True
+
+    def _scan_composite(self) -> bool:
+        """扫描嵌套对象或数组直到括号配平"""
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            pos += 1
+            if self._in_string:
+                if char == "\\":
+                    if pos >= len(buffer):
+                        pos -= 1
+                        break
+                    pos += 1
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos = pos
+                    self._complete(json.loads(buffer[self._value_start:pos]))
+                    return True
+        self._pos = pos
+        return False
+
+    def _scan_literal(self) -> bool:
+        """数字、true/false/null 要等到分隔符出现才能确定已经完整"""
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer) and buffer[pos] not in ",} \t\r\n":
+            pos += 1
+        self._pos = pos
+        if pos >= len(buffer):
+            return False
+        self._complete(json.loads(buffer[self._value_start:pos]))
+        return True
+
+    def _complete(self, value: Any) -> None:
+        key = self._key
+        self.fields[key] = value
+        self._state = "after_value"
+        if self.on_field:
+            self.on_field(key, value)
+
+
+def _decode_fragment(raw: str) -> str:
+    """解码字符串值中一段完整的（不截断转义序列的）片段"""
+    if "\\" not in raw:
+        return raw
+    try:
+        return json.loads(f'"{raw}"')
+    except ValueError:
+        return raw
+
+
+def parse_json_object(text: str) -> Dict[str, Any]:
+    """从完整的 LLM 输出中解析第一个 JSON 对象，对象不完整时抛出 json.JSONDecodeError"""
+    parser = JsonObjectStreamParser()
+    parser.feed(text)
+    if not parser.done:
+        raise json.JSONDecodeError("JSON 对象不完整", text, len(text))
+    return parser.fields
+
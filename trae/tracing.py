@@ -0,0 +1,165 @@
+"""
+耗时追踪 - 记录一次查询在配置加载、历史读取、规划、执行、总结等阶段的耗时
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台不加锁
+    fcntl = None
+
+
+@dataclass
+class Span:
+    """一个阶段：start 为相对追踪开始的秒数，depth 为嵌套层级"""
+    name: str
+    start: float
+    duration: float = 0.0
+    depth: int = 0
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    def set(self, **attrs: Any) -> None:
+        """补充属性，如首个 token 延迟、返回码"""
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "start_ms": round(self.start * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "depth": self.depth,
+            "attrs": self.attrs,
+        }
+
+
+class _NullSpan(Span):
+    def set(self, **attrs: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan("", 0.0)
+
+
+class Tracer:
+    """收集各阶段的 Span
+
+    span() 可以嵌套，嵌套层级按线程分别维护；关闭时（enabled=False）
+    span() 不计时也不保存任何内容，可以放心留在热路径上。
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._started_at = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Span]:
+        """记录 with 块的耗时；块内抛出的异常记为 error 属性后继续抛出"""
+        if not self.enabled:
+            yield _NULL_SPAN
+            return
+        stack = self._stack()
+        current = Span(name, time.perf_counter() - self._origin, depth=len(stack), attrs=dict(attrs))
+        with self._lock:
+            self.spans.append(current)
+        stack.append(current)
+        try:
+            yield current
+        except BaseException as e:
+            current.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            current.duration = time.perf_counter() - self._origin - current.start
+            stack.pop()
+
+    def add(self, name: str, duration: float, **attrs: Any) -> None:
+        """记录在别处测得的耗时（如流式解析的累计时间），挂在当前 span 之下"""
+        if not self.enabled:
+            return
+        depth = len(self._stack())
+        end = time.perf_counter() - self._origin
+        with self._lock:
+            self.spans.append(Span(name, max(0.0, end - duration), duration, depth, dict(attrs)))
+
+    def merge(self, spans: Optional[Iterable[Dict[str, Any]]], parent: Span) -> None:
+        """并入守护进程返回的 span（to_dict 格式），按 parent 的开始时间重新定位"""
+        if not self.enabled or not spans:
+            return
+        with self._lock:
+            for data in spans:
+                self.spans.append(Span(
+                    data.get("name", ""),
+                    parent.start + data.get("start_ms", 0) / 1000,
+                    data.get("duration_ms", 0) / 1000,
+                    parent.depth + 1 + data.get("depth", 0),
+                    dict(data.get("attrs") or {}),
+                ))
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return [span.to_dict() for span in spans]
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._origin
+
+    def format_breakdown(self) -> str:
+        """按开始时间排列的阶段耗时表，子阶段缩进显示"""
+        lines = ["阶段耗时:"]
+        for data in self.to_dicts():
+            label = "  " * data["depth"] + data["name"]
+            extras = "  ".join(f"{key}={_format_attr(value)}" for key, value in data["attrs"].items())
+            lines.append(f"  {label:<28} {data['duration_ms']:>10.1f} ms  {extras}".rstrip())
+        lines.append(f"  {'总计':<26} {self.elapsed() * 1000:>10.1f} ms")
+        return "\n".join(lines)
+
+    def write_jsonl(self, path: str, **fields: Any) -> None:
+        """以 JSONL 追加全部 span，每行一个，附带 trace_id、开始时间戳与 fields"""
+        lines = []
+        for data in self.to_dicts():
+            record = {"trace_id": self.trace_id, "ts": round(self._started_at + data["start_ms"] / 1000, 3)}
+            record.update(fields)
+            record.update(data)
+            lines.append(json.dumps(record, ensure_ascii=False))
+        if not lines:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        # O_APPEND 追加并持有 flock，多个进程写同一文件时各自整批的行不会交错
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+
+def _format_attr(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+
+# 未开启 --timings / --trace-file 时使用的共享实例
+NULL_TRACER = Tracer(enabled=False)